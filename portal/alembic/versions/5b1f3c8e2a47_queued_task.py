@@ -0,0 +1,30 @@
+"""queued task
+
+Revision ID: 5b1f3c8e2a47
+Revises: 220e73af46b9
+Create Date: 2026-10-17 07:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b1f3c8e2a47'
+down_revision = '220e73af46b9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('queued_task',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('queue', sa.String(), nullable=False),
+    sa.Column('body', sa.Text(), nullable=False),
+    sa.Column('created', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('queued_task')
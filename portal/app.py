@@ -2,10 +2,11 @@ import os
 from flask import Flask, redirect, jsonify, url_for, request
 from flask_admin import helpers as admin_helpers
 from flask_security import Security, login_required, SQLAlchemySessionUserDatastore
-from models import db
+from models import db, engine
 from models.user import User, Role
 from controllers import camera_type_api, processing_api, visualize_api, bathymetry_api, ratingcurve_api, project_api
 from views import admin
+from publisher import publisher
 
 # Create flask app
 app = Flask(__name__, template_folder="templates")
@@ -40,6 +41,9 @@ def index():
 # Create admin interface
 admin.init_app(app)
 
+# Publish processing tasks in the background, including tasks left by stopped workers
+publisher.start(engine)
+
 @security.context_processor
 def security_context_processor():
     """
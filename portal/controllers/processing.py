@@ -42,6 +42,21 @@ def processing_compute_piv(id):
             "discharge_q50": {"type": "number"},
             "discharge_q75": {"type": "number"},
             "discharge_q95": {"type": "number"},
+            "transects": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "bathymetry_id": {"type": "integer"},
+                        "discharge_q05": {"type": "number"},
+                        "discharge_q25": {"type": "number"},
+                        "discharge_q50": {"type": "number"},
+                        "discharge_q75": {"type": "number"},
+                        "discharge_q95": {"type": "number"},
+                    },
+                    "additionalProperties": False,
+                },
+            },
         },
         "minProperties": 5,
         "additionalProperties": False,
@@ -53,8 +68,10 @@ def processing_compute_piv(id):
     if not movie:
         raise ValueError("Invalid movie with identifier %s" % id)
 
+    # discharge of the first cross section is stored with the movie
     for key, value in content.items():
-        setattr(movie, key, value)
+        if key.startswith("discharge_"):
+            setattr(movie, key, value)
     movie.status = MovieStatus.MOVIE_STATUS_FINISHED
 
     db.commit()
@@ -143,10 +143,38 @@ def xyla(u, v, res=0.01):
     }
 
 
+def open_velocity_filter(bucket_name):
+    """
+    Open filtered velocities of a movie. The processing node stores these either as NetCDF file or as Zarr store,
+    depending on its velocity format. If both are found, e.g. after the format was changed, the most recent is used.
+
+    :param bucket_name: name of bucket of movie
+    :return: xarray.Dataset
+    """
+    bucket = utils.get_s3().Bucket(bucket_name)
+    found = []
+    # a consolidated Zarr store is complete once its metadata is written
+    for key, marker in [
+        ("velocity_filter.nc", "velocity_filter.nc"),
+        ("velocity_filter.zarr", "velocity_filter.zarr/.zmetadata"),
+    ]:
+        found += [(obj.last_modified, key) for obj in bucket.objects.filter(Prefix=marker) if obj.key == marker]
+    if not found:
+        raise ValueError("No filtered velocities found for movie in bucket %s" % bucket_name)
+    key = max(found)[1]
+    if key.endswith(".zarr"):
+        # read without dask, only the variables that are used are fetched
+        return xr.open_dataset(utils.get_zarr_store(bucket_name, key), engine="zarr", consolidated=True, chunks=None)
+    file_stream = io.BytesIO()
+    bucket.Object(key).download_fileobj(file_stream, Config=utils.get_transfer_config())
+    file_stream.seek(0)
+    return xr.open_dataset(file_stream, engine="h5netcdf")
+
+
 @visualize_api.route("/api/visualize/get_velocity_vectors/<id>", methods=["GET"])
 def get_velocity_vectors(id):
     """
-    Retrieve JSON object with velocity vectors from the NetCDF file for a specific movie.
+    Retrieve JSON object with velocity vectors from the NetCDF file or Zarr store for a specific movie.
 
     :param id: movie identifier
     :return: JSON object with velocity vectors
@@ -155,14 +183,7 @@ def get_velocity_vectors(id):
     if not movie:
         raise ValueError("Invalid movie with identifier %s" % id)
 
-    s3 = utils.get_s3()
-    bucket_name = movie.file_bucket
-
-    file_stream = io.BytesIO()
-    s3.Object(bucket_name, "velocity_filter.nc").download_fileobj(file_stream)
-    file_stream.seek(0)
-
-    ds = xr.open_dataset(file_stream, engine="h5netcdf")
+    ds = open_velocity_filter(movie.file_bucket)
     # extract vectors and convert to Highchart data array
     u = ds["v_x"].median(dim="time")
     v = ds["v_y"].median(dim="time")
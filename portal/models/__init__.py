@@ -10,6 +10,7 @@ engine = create_engine(os.getenv("DB_CONNECTION_STRING"), pool_recycle=3600, poo
 from models import bathymetry
 from models import camera
 from models import movie
+from models import queuedtask
 from models import ratingcurve
 from models import site
 from models import user
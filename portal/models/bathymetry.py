@@ -33,6 +33,7 @@ class Bathymetry(Base, SerializerMixin):
         transform = pyproj.Transformer.from_crs(crs_bathymetry, crs_site, always_xy=True)
         coords = [list(transform.transform(c.x, c.y)) + [c.z] for c in self.coordinates]
         return {
+            "id": self.id,
             # "coords": list(map(lambda c: [c.x, c.y, c.z], self.coordinates))
             "coords": coords
         }
@@ -1,7 +1,6 @@
-import os
 import enum
-import pika
 import json
+import publisher
 from sqlalchemy import event, Integer, ForeignKey, String, Column, DateTime, Enum, Float, Text, inspect
 from sqlalchemy_serializer import SerializerMixin
 from sqlalchemy.orm import relationship, object_session
@@ -211,7 +210,7 @@ def receive_after_update(mapper, connection, target):
 
 def queue_task(type, camera_config):
     """
-    Send a task to the processing node.
+    Send a task to the processing node, once the camera config is committed.
 
     :param type: task type
     :param camera_config: camera config object instance
@@ -222,17 +221,7 @@ def queue_task(type, camera_config):
         movie_json = movie.get_task_json()
         movie_json["h_a"] = movie_json["camera_config"]["gcps"]["h_ref"]
 
-        connection = pika.BlockingConnection(
-            pika.URLParameters(os.getenv("AMQP_CONNECTION_STRING"))
-        )
-        channel = connection.channel()
-        channel.queue_declare(queue="processing")
-        channel.basic_publish(
-            exchange="",
-            routing_key="processing",
-            body=json.dumps({"type": type, "kwargs": {"movie": movie_json}})
-        )
-        connection.close()
+        publisher.queue_task(object_session(camera_config), type, {"movie": movie_json})
 
 
 class CameraType(Base, SerializerMixin):
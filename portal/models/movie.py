@@ -1,8 +1,6 @@
-import os
-import pika
-import json
 import enum
 import utils
+import publisher
 from sqlalchemy import (
     event,
     Integer,
@@ -15,7 +13,7 @@ from sqlalchemy import (
     Text,
 )
 from sqlalchemy_serializer import SerializerMixin
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, object_session
 from models.base import Base
 from models.bathymetry import Bathymetry
 
@@ -133,22 +131,12 @@ def receive_after_update(mapper, connection, target):
 
 def queue_task(type, movie):
     """
-    Send task to processing node.
+    Send task to processing node, once the movie is committed.
 
     :param type: task type
     :param movie: movie object instance
     """
-    connection = pika.BlockingConnection(
-        pika.URLParameters(os.getenv("AMQP_CONNECTION_STRING"))
-    )
-    channel = connection.channel()
-    channel.queue_declare(queue="processing")
-    channel.basic_publish(
-        exchange="",
-        routing_key="processing",
-        body=json.dumps({"type": type, "kwargs": {"movie": movie.get_task_json() }}),
-    )
-    connection.close()
+    publisher.queue_task(object_session(movie), type, {"movie": movie.get_task_json()})
 
 @event.listens_for(Movie, 'after_delete')
 def receive_after_update(mapper, connection, target):
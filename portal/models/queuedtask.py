@@ -0,0 +1,22 @@
+import datetime
+from sqlalchemy import Integer, String, Column, DateTime, Text
+from models.base import Base
+
+
+class QueuedTask(Base):
+    """
+    Task for the processing node that is not yet published. Tasks are stored in the same transaction as the change
+    that caused them, and removed once the broker confirmed them, so that a task is not lost if the portal stops
+    before publishing it.
+    """
+    __tablename__ = "queued_task"
+    id = Column(Integer, primary_key=True)
+    queue = Column(String, nullable=False)
+    body = Column(Text, nullable=False)
+    created = Column(DateTime, default=datetime.datetime.utcnow)
+
+    def __str__(self):
+        return "{}".format(self.id)
+
+    def __repr__(self):
+        return "{}".format(self.__str__())
@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import logging
+import threading
+import pika
+import utils
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models.queuedtask import QueuedTask
+
+# seconds between checks for tasks that were stored but not published (e.g. by a stopped worker), also used to
+# answer heartbeats of the connection
+POLL_INTERVAL = 5
+# maximum seconds between attempts to publish tasks while the broker is unreachable
+MAX_RETRY_INTERVAL = 30
+
+logger = logging.getLogger(__name__)
+
+
+class Publisher(object):
+    """
+    Publishes stored tasks (see QueuedTask) to the processing queues over one long-lived connection, owned by a
+    background thread. Deliveries are confirmed by the broker before a task is removed, so tasks are published at
+    least once, also after a restart of the portal or an outage of the broker. Tasks are taken with
+    SELECT ... FOR UPDATE SKIP LOCKED, so that several processes publish stored tasks without publishing the same
+    task at the same time.
+    """
+    def __init__(self, url):
+        """
+        :param url: str, AMQP connection string
+        """
+        self.url = url
+        self.engine = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._connection = None
+        self._channel = None
+        self._declared = set()
+
+    def start(self, engine):
+        """
+        Start publishing stored tasks in a background thread of this process, including tasks that were left by
+        earlier processes
+
+        :param engine: sqlalchemy engine of the database with stored tasks
+        :return: None
+        """
+        with self._lock:
+            # a forked process gets its own thread and connection
+            if self._thread is None or self._pid != os.getpid():
+                self.engine = engine
+                self._wakeup = threading.Event()
+                self._connection = None
+                self._thread = threading.Thread(target=self._run, name="publisher", daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+        self._wakeup.set()
+
+    def notify(self):
+        """
+        Publish newly stored tasks now, instead of at the next check
+
+        :return: None
+        """
+        if self._thread is not None and self._pid == os.getpid():
+            self._wakeup.set()
+
+    def _connect(self):
+        self._connection = pika.BlockingConnection(pika.URLParameters(self.url))
+        self._channel = self._connection.channel()
+        # basic_publish waits until the broker confirms that it took over the message
+        self._channel.confirm_delivery()
+        self._declared = set()
+
+    def _disconnect(self):
+        try:
+            if self._connection is not None and self._connection.is_open:
+                self._connection.close()
+        except pika.exceptions.AMQPError:
+            pass
+        self._connection = None
+        self._channel = None
+
+    def _send(self, queue_name, body):
+        if self._connection is None or not self._connection.is_open:
+            self._connect()
+        if queue_name not in self._declared:
+            self._channel.queue_declare(queue=queue_name)
+            self._declared.add(queue_name)
+        self._channel.basic_publish(
+            exchange="",
+            routing_key=queue_name,
+            body=body,
+            properties=pika.BasicProperties(delivery_mode=2),
+            mandatory=True,
+        )
+
+    def _publish_one(self):
+        """
+        Publish the oldest stored task that no other process is publishing, and remove it once it is confirmed
+
+        :return: bool, True if a task was published
+        """
+        table = QueuedTask.__table__
+        with self.engine.begin() as connection:
+            task = connection.execute(
+                table.select().order_by(table.c.id).limit(1).with_for_update(skip_locked=True)
+            ).first()
+            if task is None:
+                return False
+            self._send(task.queue, task.body)
+            connection.execute(table.delete().where(table.c.id == task.id))
+        return True
+
+    def _run(self):
+        retry_interval = 1
+        while True:
+            self._wakeup.wait(POLL_INTERVAL)
+            self._wakeup.clear()
+            try:
+                while self._publish_one():
+                    pass
+                # answer heartbeats of an idle connection
+                if self._connection is not None and self._connection.is_open:
+                    self._connection.process_data_events(time_limit=0)
+                retry_interval = 1
+            except Exception as e:
+                # stored tasks stay in the database, and are published at a next attempt
+                logger.error(f"Publishing tasks failed with error {e}, retrying")
+                self._disconnect()
+                time.sleep(retry_interval)
+                retry_interval = min(2 * retry_interval, MAX_RETRY_INTERVAL)
+                self._wakeup.set()
+
+
+publisher = Publisher(os.getenv("AMQP_CONNECTION_STRING"))
+
+
+def queue_task(session, type, kwargs):
+    """
+    Queue a task for the processing node. The task is stored in the transaction of the session, so that it is only
+    published if the session is committed, and not lost if the portal stops before publishing it.
+
+    :param session: sqlalchemy session in which the task is created, may be flushing
+    :param type: task type
+    :param kwargs: dict, arguments of task
+    :return: None
+    """
+    # inserted with the connection of the session, also while the session is flushing
+    session.connection().execute(
+        QueuedTask.__table__.insert().values(
+            queue=utils.get_task_queue(type),
+            body=json.dumps({"type": type, "kwargs": kwargs}),
+        )
+    )
+    session.info["queued_tasks"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def receive_after_commit(session):
+    """
+    Publish tasks of a committed session.
+
+    :param session:
+    """
+    if session.info.pop("queued_tasks", False):
+        publisher.notify()
+
+
+@event.listens_for(Session, "after_rollback")
+def receive_after_rollback(session):
+    """
+    Forget tasks of a rolled back session, these were rolled back with the session.
+
+    :param session:
+    """
+    session.info.pop("queued_tasks", None)
@@ -1,29 +1,125 @@
 import boto3
+import boto3.s3.transfer
 import os
+import threading
 import pyproj
 import ibm_boto3
+import ibm_boto3.s3.transfer
 from ibm_botocore.client import Config
 
+# maximum number of open connections kept per S3 connection
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("ORC_S3_MAX_POOL_CONNECTIONS", 16))
+# files larger than the threshold (MB) are transferred in parts of chunk size (MB), with max concurrency parallel parts
+S3_MULTIPART_THRESHOLD = int(os.getenv("ORC_S3_MULTIPART_THRESHOLD", 64))
+S3_MULTIPART_CHUNKSIZE = int(os.getenv("ORC_S3_MULTIPART_CHUNKSIZE", 16))
+S3_MAX_CONCURRENCY = int(os.getenv("ORC_S3_MAX_CONCURRENCY", 8))
+
+# S3 connection of this process, see get_s3: session and client shared by all threads, and a resource per thread
+_s3 = {}
+_s3_local = threading.local()
+_s3_lock = threading.Lock()
+
+# queue of tasks a user is waiting for, served by reserved task slots of the processing nodes
+INTERACTIVE_QUEUE = "processing_interactive"
+# queue of long running batch tasks
+BATCH_QUEUE = "processing"
+INTERACTIVE_TASKS = ["extract_frames", "get_aoi", "run_camera_config"]
+
+def get_task_queue(type):
+    """
+    Get queue of a processing task, tasks a user is waiting for go to the interactive queue, so that they are not
+    queued behind long running movie runs.
+
+    :param type: task type
+    :return: str, name of queue
+    """
+    return INTERACTIVE_QUEUE if type in INTERACTIVE_TASKS else BATCH_QUEUE
+
 def get_s3():
     """
-    Get boto3 resource connection to the S3 file storage.
+    Get boto3 resource connection to the S3 file storage. The session and client are made once per process and shared
+    by all its threads, so that the pool of open connections of the client is reused. Clients are thread safe, but
+    resources are not, therefore every thread gets its own resource, which sends its requests with the shared client.
+
+    :return: boto3 resource
+    """
+    resource = getattr(_s3_local, "resource", None)
+    if resource is None:
+        # sessions are not thread safe either, so clients and resources are made while holding the lock
+        with _s3_lock:
+            if "client" not in _s3:
+                _s3["session"], _s3["kwargs"] = _new_session()
+                _s3["client"] = _s3["session"].client("s3", **_s3["kwargs"])
+            resource = _s3["session"].resource("s3", **_s3["kwargs"])
+            # objects made from the resource (e.g. Bucket, Object) send their requests with the client of the resource
+            resource.meta.client = _s3["client"]
+        _s3_local.resource = resource
+    return resource
+
+def _reset_s3():
+    # a forked process must not share the connections of its parent, nor a lock that was held while forking
+    global _s3_local, _s3_lock
+    _s3.clear()
+    _s3_local = threading.local()
+    _s3_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_s3)
 
-    :return:
+def _new_session():
     """
-    return boto3.resource(
-        "s3",
-        endpoint_url=os.getenv("S3_ENDPOINT_URL"),
-        aws_access_key_id=os.getenv("S3_ACCESS_KEY"),
-        aws_secret_access_key=os.getenv("S3_ACCESS_SECRET"),
-        config=boto3.session.Config(signature_version="s3v4"),
-    ) if os.getenv("FLASK_ENV") != "ibmcloud" else ibm_boto3.resource('s3',
+    :return: tuple (session, kwargs), new boto3 session and the arguments of its S3 clients and resources
+    """
+    if os.getenv("FLASK_ENV") != "ibmcloud":
+        return boto3.session.Session(), dict(
+            endpoint_url=os.getenv("S3_ENDPOINT_URL"),
+            aws_access_key_id=os.getenv("S3_ACCESS_KEY"),
+            aws_secret_access_key=os.getenv("S3_ACCESS_SECRET"),
+            config=boto3.session.Config(signature_version="s3v4", max_pool_connections=S3_MAX_POOL_CONNECTIONS),
+        )
+    return ibm_boto3.session.Session(), dict(
         ibm_api_key_id=os.getenv('S3_ACCESS_KEY'),
         ibm_service_instance_id=os.getenv('S3_ACCESS_SECRET'),
         ibm_auth_endpoint=os.getenv('COS_AUTH_ENDPOINT'),
-        config=Config(signature_version="oauth"),
+        config=Config(signature_version="oauth", max_pool_connections=S3_MAX_POOL_CONNECTIONS),
         endpoint_url=os.getenv('S3_ENDPOINT_URL')
     )
 
+def get_transfer_config():
+    """
+    Get configuration of file transfers, passed as Config to upload and download methods, so that large files are
+    transferred in parallel parts.
+
+    :return: TransferConfig
+    """
+    transfer = boto3.s3.transfer if os.getenv("FLASK_ENV") != "ibmcloud" else ibm_boto3.s3.transfer
+    return transfer.TransferConfig(
+        multipart_threshold=S3_MULTIPART_THRESHOLD * 1024 ** 2,
+        multipart_chunksize=S3_MULTIPART_CHUNKSIZE * 1024 ** 2,
+        max_concurrency=S3_MAX_CONCURRENCY,
+    )
+
+def get_zarr_store(bucket, key):
+    """
+    Get a key-value store for reading a Zarr store in the bucket, as written by the processing node. Requires the
+    optional dependencies s3fs and zarr.
+
+    :param bucket: str, name of bucket
+    :param key: str, name of Zarr store in bucket
+    :return: s3fs.S3Map
+    """
+    if os.getenv("FLASK_ENV") == "ibmcloud":
+        raise ValueError("Zarr stores are not supported with the oauth signature of IBM cloud storage")
+    try:
+        import s3fs
+    except ImportError:
+        raise ImportError("Zarr stores in S3 require s3fs and zarr, install these with pip install s3fs zarr")
+    fs = s3fs.S3FileSystem(
+        key=os.getenv("S3_ACCESS_KEY"),
+        secret=os.getenv("S3_ACCESS_SECRET"),
+        client_kwargs={"endpoint_url": os.getenv("S3_ENDPOINT_URL")},
+    )
+    return s3fs.S3Map(root=f"{bucket}/{key}", s3=fs, check=False)
+
 def get_projs(user_projs=[]):
     """
     Retrieve a serializable list of pyproj supported codes. Currently supported are all UTM zones and Latitude-longitude
@@ -37,7 +37,8 @@ class s3UploadField(form.FileUploadField):
         else:
             raise ValidationError("Bucket already exists")
 
-        s3.Bucket(bucket).Object(self.data.filename).put(Body=data.read())
+        # large movies are uploaded in parallel parts, without reading them into memory first
+        s3.Bucket(bucket).upload_fileobj(data.stream, self.data.filename, Config=utils.get_transfer_config())
 
         return self.data.filename
 
@@ -1,58 +1,257 @@
-import requests
-import pika
-import traceback
-import os
-import json
-import tasks
-import log
-
-logger = log.start_logger(True, False)
-
-# Callback function for each process task that is queued.
-def process(ch, method, properties, body):
-    try:
-        taskInput = json.loads(body.decode("utf-8"))
-        task_name = taskInput["type"]
-        kwargs = taskInput["kwargs"]
-        if hasattr(tasks, task_name):
-            task = getattr(tasks, task_name)
-            logger.info("Process task of type %s" % taskInput["type"])
-            logger.debug(f"kwargs: {kwargs}")
-            try:
-                task(**kwargs, logger=logger)
-                logger.info(f"Task {task_name} was successful")
-                # Acknowledge queue item at end of task.
-                ch.basic_ack(delivery_tag=method.delivery_tag)
-                r = 200
-            except BaseException as e:
-                logger.error(f"{task_name} failed with error {e}")
-                # Acknowledge queue item at end of task.
-                ch.basic_ack(delivery_tag=method.delivery_tag)
-                requests.post(
-                    "{}/processing/error/{}".format(os.getenv("ORC_API_URL"), taskInput["kwargs"]["movie"]["id"]),
-                    json={"error_message": str(e)},
-                )
-                r = 500
-
-    except Exception as e:
-        print("Processing failed with error: %s" % str(e))
-        traceback.print_tb(e.__traceback__)
-
-
-connection = pika.BlockingConnection(
-    pika.URLParameters('{}?heartbeat=1800&blocked_connection_timeout=900'.format(os.getenv("AMQP_CONNECTION_STRING")))
-)
-channel = connection.channel()
-channel.queue_declare(queue="processing")
-# Process a single task at a time.
-channel.basic_qos(prefetch_count=1)
-channel.basic_consume(queue="processing", on_message_callback=process)
-
-try:
-    print("Start listening for processing tasks in queue.")
-    channel.start_consuming()
-except Exception as e:
-    print("Reboot service due to error: %s" % str(e))
-    channel.stop_consuming()
-    connection.close()
-    traceback.print_tb(e.__traceback__)
+import requests
+import pika
+import traceback
+import os
+import json
+import functools
+import itertools
+import queue
+import threading
+import multiprocessing
+import tasks
+import log
+
+# number of batch tasks processed at the same time, each in its own process
+WORKER_SLOTS = int(os.getenv("ORC_WORKER_SLOTS", 1))
+# number of task slots reserved for interactive tasks, that a user is waiting for
+INTERACTIVE_SLOTS = int(os.getenv("ORC_INTERACTIVE_SLOTS", 1))
+# queues of batch and interactive tasks, the portal chooses the queue by task type
+BATCH_QUEUE = "processing"
+INTERACTIVE_QUEUE = "processing_interactive"
+# seconds between AMQP heartbeats, the broker closes the connection of a worker that misses two of them
+AMQP_HEARTBEAT = int(os.getenv("ORC_AMQP_HEARTBEAT", 30))
+# amount of tasks after which the process of a task slot is replaced, e.g. to release memory, 0 for never
+SLOT_MAX_TASKS = int(os.getenv("ORC_SLOT_MAX_TASKS", 0))
+# slot processes are forked from a server process that is started before the worker connects, so that processes
+# started later on (e.g. replacing a killed process) do not inherit the connection or threads of the worker
+mp_context = multiprocessing.get_context("forkserver")
+mp_context.set_forkserver_preload(["tasks"])
+
+logger = log.start_logger(True, False)
+
+
+def run_task(taskInput):
+    """
+    Run a processing task, and report errors of the task to the API
+
+    :param taskInput: dict, with task type and kwargs
+    :return: bool, True if task was successful
+    """
+    task_name = taskInput["type"]
+    kwargs = taskInput["kwargs"]
+    if not hasattr(tasks, task_name):
+        logger.error(f"Unknown task type {task_name}")
+        return False
+    task = getattr(tasks, task_name)
+    logger.info("Process task of type %s" % taskInput["type"])
+    logger.debug(f"kwargs: {kwargs}")
+    try:
+        task(**kwargs, logger=logger)
+        logger.info(f"Task {task_name} was successful")
+        return True
+    except BaseException as e:
+        logger.error(f"{task_name} failed with error {e}")
+        # tasks without movie (e.g. run_batch) report errors of their movies themselves
+        if "movie" in kwargs:
+            _report_error([kwargs["movie"]["id"]], str(e))
+        return False
+
+
+def _report_error(movie_ids, error_message):
+    """
+    Report an error to the API, for each of the given movies
+
+    :param movie_ids: list of ids of movies
+    :param error_message: str, error message
+    :return: None
+    """
+    for movie_id in movie_ids:
+        try:
+            requests.post(
+                "{}/processing/error/{}".format(os.getenv("ORC_API_URL"), movie_id),
+                json={"error_message": error_message},
+            )
+        except Exception as e:
+            print("Reporting error failed with error: %s" % str(e))
+
+
+def _unfinished_movies(body, finished):
+    """
+    Get movies of a task of which no result or error was reported
+
+    :param body: bytes, message with task
+    :param finished: set, ids of movies of which the result or error was reported (see run_batch)
+    :return: list of ids of movies
+    """
+    try:
+        kwargs = json.loads(body.decode("utf-8"))["kwargs"]
+    except (ValueError, KeyError):
+        return []
+    if "movie" in kwargs:
+        return [kwargs["movie"]["id"]]
+    return [movie["id"] for movie in kwargs.get("movies", []) if movie["id"] not in finished]
+
+
+def _run_slot(conn):
+    """
+    Entry point of the process of a task slot, running tasks received over a pipe one at a time. The process lives
+    as long as the worker, so that caches of the tasks (e.g. remap tables, grid coordinates) are kept for next tasks.
+
+    :param conn: multiprocessing.connection.Connection, receiving messages with tasks, and sending back tuples
+        ("finished", id) for every finished movie of a batch, and ("done", result) with whether a task was successful
+    :return: None
+    """
+    while True:
+        try:
+            body = conn.recv()
+        except EOFError:
+            # worker stopped
+            return
+        if body is None:
+            return
+        task_input = json.loads(body.decode("utf-8"))
+        if task_input["type"] == "run_batch":
+            # finished movies are passed on, so that only the unfinished ones are reported if the process is killed
+            task_input["kwargs"]["on_finished"] = lambda movie_id: conn.send(("finished", movie_id))
+        conn.send(("done", run_task(task_input)))
+
+
+class TaskSlot(object):
+    """
+    Runs tasks in a long-lived process, one task at a time. A process that is killed while running a task (e.g. out of
+    memory) is replaced by a new one, and so is a process that ran max_tasks tasks.
+    """
+    def __init__(self, name, max_tasks=SLOT_MAX_TASKS):
+        """
+        :param name: str, name of slot process
+        :param max_tasks: int, amount of tasks after which the process is replaced, 0 for never
+        """
+        self.name = name
+        self.max_tasks = max_tasks
+        self.start()
+
+    def start(self):
+        """
+        Start the slot process
+
+        :return: None
+        """
+        self.conn, child_conn = mp_context.Pipe()
+        # not daemonic, so that tasks can start worker processes of their own
+        self.process = mp_context.Process(target=_run_slot, args=(child_conn,), name=self.name)
+        self.process.start()
+        child_conn.close()
+        self.n_tasks = 0
+
+    def stop(self):
+        """
+        Stop the slot process after its current task
+
+        :return: None
+        """
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+
+    def run(self, body):
+        """
+        Run a task in the slot process, and wait until it is finished
+
+        :param body: bytes, message with task
+        :return: bool, True if task was successful
+        """
+        self.conn.send(body)
+        # movies of a batch of which the result or error was reported
+        finished = set()
+        try:
+            message, result = self.conn.recv()
+            while message == "finished":
+                finished.add(result)
+                message, result = self.conn.recv()
+        except (EOFError, ConnectionResetError):
+            # killed (e.g. out of memory) before the task could report its error, finished movies keep their status
+            self.process.join()
+            logger.error(f"Task process {self.process.pid} stopped with exit code {self.process.exitcode}")
+            _report_error(
+                _unfinished_movies(body, finished), f"Processing stopped with exit code {self.process.exitcode}"
+            )
+            self.start()
+            return False
+        self.n_tasks += 1
+        if self.max_tasks and self.n_tasks >= self.max_tasks:
+            logger.info(f"Replacing process of task slot {self.name} after {self.n_tasks} tasks")
+            self.stop()
+            self.process.join()
+            self.start()
+        return result
+
+
+def _serve_slot(connection, slot, jobs):
+    """
+    Run queue items one after the other in a task slot, and acknowledge them from the connection thread
+
+    :param connection: pika.BlockingConnection
+    :param slot: TaskSlot
+    :param jobs: queue.Queue, with tuples (ch, method, body) of queue items
+    :return: None
+    """
+    while True:
+        ch, method, body = jobs.get()
+        slot.run(body)
+        # pika connections are not thread safe, so the ack is handed over to the connection thread
+        try:
+            connection.add_callback_threadsafe(functools.partial(ch.basic_ack, delivery_tag=method.delivery_tag))
+        except Exception as e:
+            # connection was lost, the queue item is delivered again by the broker
+            print("Acknowledging task failed with error: %s" % str(e))
+
+
+def process(jobs, ch, method, properties, body):
+    """
+    Callback function for each process task that is queued, handing the task over to the task slots of its queue, so
+    that the connection thread keeps serving heartbeats and several tasks can run at the same time.
+    """
+    jobs.put((ch, method, body))
+
+
+def main():
+    queues = [(name, n) for name, n in [(BATCH_QUEUE, WORKER_SLOTS), (INTERACTIVE_QUEUE, INTERACTIVE_SLOTS)] if n > 0]
+    # slot processes are started before connecting, so that the fork server does not inherit the connection
+    slots = {name: [TaskSlot(f"{name}-{i}") for i in range(n)] for name, n in queues}
+    # tasks do not block the connection thread, so heartbeats can be short and a lost worker is noticed quickly
+    connection = pika.BlockingConnection(
+        pika.URLParameters('{}?heartbeat={:d}'.format(os.getenv("AMQP_CONNECTION_STRING"), AMQP_HEARTBEAT))
+    )
+    # every queue has its own channel, so that the prefetch counts limit the task slots of each queue separately
+    channels = []
+    for name, n in queues:
+        jobs = queue.Queue()
+        for slot in slots[name]:
+            threading.Thread(target=_serve_slot, args=(connection, slot, jobs), daemon=True).start()
+        channel = connection.channel()
+        channel.queue_declare(queue=name)
+        # Process as many tasks at a time as there are task slots.
+        channel.basic_qos(prefetch_count=n)
+        logger.info(f"Processing up to {n} task(s) at the same time from queue {name}")
+        channel.basic_consume(queue=name, on_message_callback=functools.partial(process, jobs))
+        channels.append(channel)
+
+    try:
+        print("Start listening for processing tasks in queue.")
+        # serve deliveries of all channels, and callbacks of finished tasks
+        while True:
+            connection.process_data_events(time_limit=None)
+    except Exception as e:
+        print("Reboot service due to error: %s" % str(e))
+        for channel in channels:
+            channel.stop_consuming()
+        connection.close()
+        traceback.print_tb(e.__traceback__)
+        # slot processes finish their current task and stop, unacknowledged tasks are delivered again by the broker
+        for slot in itertools.chain(*slots.values()):
+            slot.stop()
+
+
+if __name__ == "__main__":
+    main()
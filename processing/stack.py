@@ -0,0 +1,207 @@
+import os
+import json
+import shutil
+import tempfile
+import functools
+import numpy as np
+from collections import namedtuple
+
+# directory in which frame stacks are kept on local disk, between tasks
+STACK_DIR = os.getenv("ORC_FRAME_STACK_DIR", os.path.join(tempfile.gettempdir(), "orc_frames"))
+# maximum size in MB of all frame stacks together, least recently used stacks are removed first
+STACK_SIZE = int(os.getenv("ORC_FRAME_STACK_SIZE", 20480))
+
+# reference to one frame of a stack, which can be sent to worker processes without copying the frame
+FrameRef = namedtuple("FrameRef", ["fn", "shape", "dtype", "index"])
+
+
+def path(bucket, prefix):
+    """
+    Get directory of the frame stack of a movie
+
+    :param bucket: str, name of bucket of movie
+    :param prefix: str, prefix of projected frames
+    :return: str, directory of frame stack
+    """
+    return os.path.join(STACK_DIR, bucket, prefix)
+
+
+def open_stack(stack_dir, input_hash):
+    """
+    Open frame stack as a memory-mapped array, if it is complete and made from the given inputs
+
+    :param stack_dir: str, directory of frame stack
+    :param input_hash: str, hash of inputs of projected frames
+    :return: tuple (frames, meta) with frames (np.memmap, shape: frames, rows, cols) and dict with meta data ("times"
+        in milliseconds, "shape", "dtype", "transform", "crs"), or None if no usable stack is found
+    """
+    try:
+        with open(os.path.join(stack_dir, "frames.json"), "r") as f:
+            meta = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if input_hash is None or meta["hash"] != input_hash:
+        return None
+    if meta["dtype"] != np.dtype(np.uint8).str:
+        # stacked by earlier versions from int8 GeoTIFF frames, piv takes the uint8 values
+        return None
+    try:
+        frames = _memmap(os.path.join(stack_dir, meta["fn"]), tuple(meta["shape"]), meta["dtype"])
+    except FileNotFoundError:
+        # removed by evict in the meantime
+        return None
+    # mark stack as used, see evict
+    os.utime(os.path.join(stack_dir, "frames.json"))
+    return frames, meta
+
+
+def refs(frames):
+    """
+    Get references to all frames of a stack
+
+    :param frames: np.memmap, as returned by open_stack
+    :return: list of FrameRef
+    """
+    return [FrameRef(frames.filename, frames.shape, frames.dtype.str, n) for n in range(len(frames))]
+
+
+def load(frame):
+    """
+    Get frame from a reference, frames that are already arrays are returned as is
+
+    :param frame: FrameRef or np.ndarray
+    :return: np.ndarray, frame
+    """
+    if isinstance(frame, FrameRef):
+        return _memmap(frame.fn, frame.shape, frame.dtype)[frame.index]
+    return frame
+
+
+@functools.lru_cache(maxsize=4)
+def _memmap(fn, shape, dtype):
+    # mapped once per process, afterwards frames are served from the page cache
+    return np.memmap(fn, dtype=dtype, mode="r", shape=shape)
+
+
+def evict(root=STACK_DIR, max_size=STACK_SIZE, keep=()):
+    """
+    Remove least recently used frame stacks, until all frame stacks together fit within the maximum size. Processes
+    that mapped a removed stack keep reading it until they are done.
+
+    :param root: str, directory in which frame stacks are kept
+    :param max_size: float, maximum size in MB of all frame stacks together
+    :param keep: list of str, directories of frame stacks that are not removed, e.g. stacks in use
+    :return: list of str, directories of removed frame stacks
+    """
+    keep = [os.path.abspath(stack_dir) for stack_dir in keep]
+    stacks = []
+    for stack_dir, _, fns in os.walk(root):
+        if not fns:
+            continue
+        try:
+            stats = [os.stat(os.path.join(stack_dir, fn)) for fn in fns]
+        except FileNotFoundError:
+            continue
+        # last use is the last change of any file, so that stacks that are being written are removed last
+        stacks.append((max(stat.st_mtime for stat in stats), sum(stat.st_size for stat in stats), stack_dir))
+    total = sum(size for _, size, _ in stacks)
+    removed = []
+    for _, size, stack_dir in sorted(stacks):
+        if total <= max_size * 2 ** 20:
+            break
+        if os.path.abspath(stack_dir) in keep:
+            continue
+        shutil.rmtree(stack_dir, ignore_errors=True)
+        removed.append(stack_dir)
+        total -= size
+    if removed:
+        # do not keep removed stacks mapped in this process
+        _memmap.cache_clear()
+    return removed
+
+
+class StackWriter(object):
+    """
+    Writes projected frames of equal shape one by one to a raw file of 8-bit values, which is read back as one
+    memory-mapped array. The sidecar with times and geotransform is written last, so that an incomplete stack is never opened.
+    """
+    def __init__(self, stack_dir, input_hash):
+        """
+        :param stack_dir: str, directory of frame stack
+        :param input_hash: str, hash of inputs of projected frames, stored in sidecar
+        """
+        os.makedirs(stack_dir, exist_ok=True)
+        self.stack_dir = stack_dir
+        self.input_hash = input_hash
+        # unique name, so that tasks writing the same stack at the same time do not mix frames
+        fd, self.fn = tempfile.mkstemp(prefix="frames_", suffix=".u8", dir=stack_dir)
+        self.f = os.fdopen(fd, "wb")
+        self.times = []
+        self.shape = None
+        self.dtype = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.f.close()
+            os.remove(self.fn)
+
+    def append(self, ms, img):
+        """
+        Append one frame
+
+        :param ms: int, time offset of frame in milliseconds
+        :param img: np.ndarray (2D, uint8 or int8), projected frame
+        :return: None
+        """
+        if self.shape is None:
+            if img.dtype.itemsize != 1:
+                raise ValueError(f"Frames must have 8-bit values, found {img.dtype}")
+            self.shape, self.dtype = img.shape, img.dtype
+        elif img.shape != self.shape or img.dtype != self.dtype:
+            raise ValueError(
+                f"Frame of shape {img.shape} ({img.dtype}) does not fit in stack of frames of shape {self.shape} "
+                f"({self.dtype})"
+            )
+        self.f.write(np.ascontiguousarray(img).tobytes())
+        self.times.append(ms)
+
+    def close(self, transform, crs):
+        """
+        Close stack and write sidecar
+
+        :param transform: Affine, geotransform of projected frames
+        :param crs: int or str, coordinate reference system of projected frames
+        :return: None
+        """
+        self.f.close()
+        if self.shape is None:
+            raise ValueError("No frames were written to frame stack")
+        meta = {
+            "hash": self.input_hash,
+            "fn": os.path.basename(self.fn),
+            "times": self.times,
+            "shape": [len(self.times), *self.shape],
+            "dtype": self.dtype.str,
+            "transform": list(transform)[:6],
+            "crs": crs,
+        }
+        sidecar = os.path.join(self.stack_dir, "frames.json")
+        try:
+            with open(sidecar, "r") as f:
+                previous = json.load(f)["fn"]
+        except (FileNotFoundError, ValueError, KeyError):
+            previous = None
+        with tempfile.NamedTemporaryFile("w", dir=self.stack_dir, suffix=".json", delete=False) as f:
+            json.dump(meta, f)
+        os.replace(f.name, sidecar)
+        # frames of an earlier stack are removed, readers that mapped them keep them until they are done
+        if previous is not None and previous != meta["fn"]:
+            try:
+                os.remove(os.path.join(self.stack_dir, previous))
+            except FileNotFoundError:
+                pass
+        # make room for this stack
+        evict(keep=[self.stack_dir])
@@ -1,14 +1,36 @@
 import os
 import OpenRiverCam
 import utils
+import velocity
+import stack
 import logging
 import io
 import cv2
+import json
+import hashlib
+import itertools
+import functools
+import multiprocessing
+import contextlib
+import concurrent.futures
 import numpy as np
 import requests
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
 from shapely.geometry import shape
+import rasterio
 from rasterio.plot import reshape_as_raster
+from affine import Affine
+
+# remap tables for orthorectification, kept per geometry, least recently used tables are evicted first
+_remap_cache = OrderedDict()
+REMAP_CACHE_SIZE = int(os.getenv("ORC_REMAP_CACHE_SIZE", 8))
+# coordinates of PIV grids, kept for the next movies of the same camera configuration
+_grid_cache = OrderedDict()
+# number of threads encoding extracted frames to JPEG
+ENCODE_WORKERS = int(os.getenv("ORC_ENCODE_WORKERS", 4))
+# remap table, geotransform and crs used for projecting frames in worker processes, see _init_projection
+_projection = {}
 
 
 def upload_file(fn, bucket, dest=None, logger=logging):
@@ -28,113 +50,327 @@ def upload_file(fn, bucket, dest=None, logger=logging):
     # Create bucket if it doesn't exist yet.
     if s3.Bucket(bucket) not in s3.buckets.all():
         s3.create_bucket(Bucket=bucket)
-    s3.Bucket(bucket).upload_file(fn, dest)
+    s3.Bucket(bucket).upload_file(fn, dest, Config=utils.get_transfer_config())
     logger.info(f"{fn} uploaded in {bucket}")
 
 
-def extract_frames(movie, prefix="frame", start_frame=0, end_frame=0, logger=logging):
+def extract_frames(
+    movie,
+    prefix="frame",
+    start_frame=None,
+    end_frame=None,
+    encode_workers=ENCODE_WORKERS,
+    jpeg_quality=95,
+    scale=1.0,
+    logger=logging,
+):
     """
-    Extract raw frames, only lens correct using camera lensParameters, and store in RGB photos
+    Extract raw frames, only lens correct using camera lensParameters, and store in RGB photos. Frames are encoded to
+    JPEG in several threads, while the next frames are decoded.
 
     :param movie: dict containing movie information
     :param camera: dict, camera properties, such as lensParameters, name
     :param prefix="frame": str, prefix of file names, used in storage bucket, normally not changed by user
+    :param start_frame: int, first frame to extract, frames before it are not decoded, None for the first frame of the
+        movie
+    :param end_frame: int, last frame to extract (inclusive), None for the last frame of the movie
+    :param encode_workers: int, number of threads encoding frames to JPEG
+    :param jpeg_quality: int (range: 0-100), quality of JPEG photos (default: 95)
+    :param scale: float, factor with which frames are resized before encoding, e.g. 0.5 for half the width and height
+        (default: 1.0)
     :param logger=logging: logger-object
     :return: None
     """
-    # open S3 bucket
-    s3 = utils.get_s3()
     n = 0
     logger.info(
         f"Writing movie {movie['file']['identifier']} to {movie['file']['bucket']}"
     )
-    # open file from bucket in memory
+
+    def jobs(fn):
+        for i, (_t, img) in enumerate(utils.read_frames(
+            fn, start_frame=start_frame, end_frame=end_frame,
+                lens_pars=movie["camera_config"]["camera_type"]["lensParameters"]
+        )):
+            # filename in bucket, following template frame_{4-digit_framenumber}_{time_in_milliseconds}.jpg
+            dest_fn = "{:s}_{:04d}_{:06d}.jpg".format(prefix, i, int(_t * 1000))
+            yield dest_fn, img, jpeg_quality, scale
+
+    # open file from bucket
     bucket = movie["file"]["bucket"]
-    fn = movie["file"]["identifier"]
-    # make a temporary file
-    s3.Bucket(bucket).download_file(fn, fn)
-    for _t, img in OpenRiverCam.io.frames(
-        fn, start_frame=start_frame, end_frame=end_frame,
-            lens_pars=movie["camera_config"]["camera_type"]["lensParameters"]
-    ):
-        # filename in bucket, following template frame_{4-digit_framenumber}_{time_in_milliseconds}.jpg
-        dest_fn = "{:s}_{:04d}_{:06d}.jpg".format(prefix, n, int(_t * 1000))
-        logger.debug(f"Write frame {n} in {dest_fn} to S3")
-        # encode img
-        ret, im_en = cv2.imencode(".jpg", img)
-        buf = io.BytesIO(im_en)
-        # Seek beginning of bytestream
-        buf.seek(0)
-        # Put file in bucket
-        s3.Object(bucket, dest_fn).put(Body=buf)
-        n += 1
-    # clean up of temp file
-    os.remove(fn)
+    with utils.open_movie(bucket, movie["file"]["identifier"]) as fn, utils.Uploader(bucket) as uploader:
+        if encode_workers > 1:
+            # cv2 releases the GIL while encoding, so threads encode frames in parallel
+            executor = concurrent.futures.ThreadPoolExecutor(encode_workers)
+            results = utils.ordered_map(executor, _encode_jpeg, jobs(fn), max_pending=2 * encode_workers)
+        else:
+            executor = None
+            results = map(_encode_jpeg, jobs(fn))
+        try:
+            # encoded frames are returned in order of frames
+            for dest_fn, body in results:
+                logger.debug(f"Write frame {n} in {dest_fn} to S3")
+                # Put file in bucket
+                uploader.put(dest_fn, body)
+                n += 1
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        # wait until all frames are in the bucket before confirming
+        uploader.flush()
+    logger.info(f"{n} frames written to {bucket}")
 
     # API request to confirm frame extraction is finished.
     requests.post("{}/processing/extract_frames/{}".format(os.getenv("ORC_API_URL"), movie["id"]))
     #requests.post("http://localhost/api/processing/extract_frames/%s" % movie["id"])
 
 
-def extract_project_frames(movie, prefix="proj", logger=logging):
+def extract_project_frames(
+    movie, prefix="proj", start_frame=None, end_frame=None, n_workers=1, force=False, logger=logging
+):
     """
     Extract frames, lens correct, greyscale correct and project to defined AOI with GCPs, water level and camera position
     Results in GeoTIFF files in desired projection and resolution within bucket defined in movie
 
     :param movie: dict, movie information
     :param prefix="proj": str, prefix of file names, used in storage bucket, normally not changed by user
+    :param start_frame=None: int, first frame to project, frames before it are not decoded
+    :param end_frame=None: int, last frame to project (inclusive), None for the last frame of the movie
+    :param n_workers=1: int, number of worker processes used for projecting and encoding frames
+    :param force=False: bool, if True, frames are projected even if they are up to date in the bucket
     :param logger=logging: logger-object
     :return: None
     """
-    # open S3 bucket
     camera_config = movie["camera_config"]
-    s3 = utils.get_s3()
-    n = 0
+    bucket = movie["file"]["bucket"]
+    input_hash = _projection_hash(movie, start_frame, end_frame)
+    if not force and _up_to_date(bucket, prefix, input_hash, logger=logger):
+        return
+    frames = _movie_frames(movie, start_frame=start_frame, end_frame=end_frame, grayscale=True, logger=logger)
+    first = next(frames)
+    last = {}
+    manifest = []
+
+    def jobs():
+        for n, _t, img in itertools.chain([first], frames):
+            # filename in bucket, following template frame_{4-digit_framenumber}_{time_in_milliseconds}.jpg
+            dest_fn = "{:s}_{:04d}_{:06d}.tif".format(prefix, n, int(_t * 1000))
+            manifest.append({"key": dest_fn, "ms": int(_t * 1000)})
+            last["img"] = img
+            yield os.path.join(tmp, dest_fn), img
+
+    with utils.scratch_dir() as tmp:
+        # geometry is the same for all frames, so only retrieve the remap table once
+        map1, map2, transform = _get_remap(camera_config, movie["h_a"], first[2].shape, logger=logger)
+        initargs = (map1, map2, transform, camera_config["site"]["crs"])
+        if n_workers > 1:
+            logger.info(f"Projecting frames with {n_workers} worker processes")
+            executor = concurrent.futures.ProcessPoolExecutor(
+                n_workers, initializer=_init_projection, initargs=initargs
+            )
+            results = utils.ordered_map(executor, _project_encode, jobs(), max_pending=2 * n_workers)
+        else:
+            executor = None
+            _init_projection(*initargs)
+            results = map(_project_encode, jobs())
+        try:
+            with utils.Uploader(bucket) as uploader:
+                for fn in results:
+                    dest_fn = os.path.basename(fn)
+                    logger.debug(f"Write frame {dest_fn} to S3")
+                    # Put file in bucket
+                    uploader.upload_file(fn, dest_fn, remove=True)
+                uploader.flush()
+        finally:
+            if executor is not None:
+                executor.shutdown()
+    # finally write last frame as .jpg for front end and write geotransform as .csv
+    corr_img = cv2.remap(last["img"], map1, map2, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+    _write_preview(bucket, corr_img, transform)
+    _write_manifest(bucket, prefix, manifest, corr_img.shape, transform, camera_config["site"]["crs"])
+    _set_record(bucket, prefix, input_hash)
+    logger.info(f"{movie['file']['identifier']} successfully reprojected into frames in {bucket}")
+
+
+def _encode_jpeg(job):
+    """
+    encode one frame to JPEG
+
+    :param job: tuple (dest_fn, img, jpeg_quality, scale) with file name in bucket, frame, JPEG quality and factor
+        with which frame is resized
+    :return: dest_fn, bytes of JPEG photo
+    """
+    dest_fn, img, jpeg_quality, scale = job
+    if scale != 1:
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    ret, im_en = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, int(jpeg_quality)])
+    return dest_fn, im_en.tobytes()
+
+
+def _init_projection(map1, map2, transform, crs):
+    """
+    Set remap table, geotransform and crs used by _project_encode in the current process
+
+    :param map1: first map of remap table, see cv2.remap
+    :param map2: second map of remap table, see cv2.remap
+    :param transform: geotransform of the projected frames
+    :param crs: int, EPSG code of the projection
+    :return: None
+    """
+    _projection.update(map1=map1, map2=map2, transform=transform, crs=crs)
+
+
+def _project_encode(job):
+    """
+    Project a frame with the remap table set by _init_projection and write it to a GeoTIFF file
+
+    :param job: tuple (fn, img) with local file name and frame
+    :return: str, local file name
+    """
+    fn, img = job
+    corr_img = cv2.remap(img, _projection["map1"], _projection["map2"], cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+    _write_geotiff(fn, corr_img, _projection["transform"], _projection["crs"])
+    return fn
+
+
+def _movie_frames(movie, start_frame=None, end_frame=None, grayscale=False, logger=logging):
+    """
+    Generator of frames from the movie in the bucket, lens corrected with the camera lensParameters
+
+    :param movie: dict, movie information
+    :param start_frame: int, first frame to read, None for the first frame of the movie
+    :param end_frame: int, last frame to read (inclusive), None for the last frame of the movie
+    :param grayscale=False: bool, if True, frames are greyscale corrected
+    :param logger=logging: logger-object
+    :return: generator of tuples (n, t, img) with frame number, time in seconds and frame
+    """
     logger.info(
-        f"Writing movie {movie['file']['identifier']} to {movie['file']['bucket']}"
+        f"Reading movie {movie['file']['identifier']} from {movie['file']['bucket']}"
     )
-    # open file from bucket in memory
-    bucket = movie["file"]["bucket"]
-    fn = movie["file"]["identifier"]
-    # make a temporary file
-    s3.Bucket(bucket).download_file(fn, fn)
-    for _t, img in OpenRiverCam.io.frames(
-        fn, grayscale=True, lens_pars=camera_config["camera_type"]["lensParameters"]
+    # open file from bucket
+    with utils.open_movie(movie["file"]["bucket"], movie["file"]["identifier"]) as fn:
+        for n, (_t, img) in enumerate(utils.read_frames(
+            fn,
+            start_frame=start_frame,
+            end_frame=end_frame,
+            grayscale=grayscale,
+            lens_pars=movie["camera_config"]["camera_type"]["lensParameters"],
+        )):
+            yield n, _t, img
+
+
+def _project_frames(movie, start_frame=None, end_frame=None, logger=logging):
+    """
+    Generator of frames from the movie in the bucket, lens corrected, greyscale corrected and projected to defined AOI
+    with GCPs, water level and camera position
+
+    :param movie: dict, movie information
+    :param start_frame: int, first frame to read, None for the first frame of the movie
+    :param end_frame: int, last frame to read (inclusive), None for the last frame of the movie
+    :param logger=logging: logger-object
+    :return: generator of tuples (n, t, corr_img, transform) with frame number, time in seconds, projected image and
+        its geotransform
+    """
+    for n, _t, img in _movie_frames(
+        movie, start_frame=start_frame, end_frame=end_frame, grayscale=True, logger=logger
     ):
-        # filename in bucket, following template frame_{4-digit_framenumber}_{time_in_milliseconds}.jpg
-        dest_fn = "{:s}_{:04d}_{:06d}.tif".format(prefix, n, int(_t * 1000))
-        logger.debug(f"Write frame {n} in {dest_fn} to S3")
-        bbox = shape(
-            camera_config["aoi"]["bbox"]["features"][0]["geometry"]
-        )  # extract the one and only geometry from geojson
+        if n == 0:
+            # geometry is the same for all frames, so only retrieve the remap table once
+            map1, map2, transform = _get_remap(movie["camera_config"], movie["h_a"], img.shape, logger=logger)
         # reproject frame with camera_config
-        # inputs needed
-        corr_img, transform = OpenRiverCam.cv.orthorectification(
-            img=img,
+        corr_img = cv2.remap(img, map1, map2, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+        yield n, _t, corr_img, transform
+
+
+def _get_remap(camera_config, h_a, img_shape, logger=logging):
+    """
+    Get the remap table that projects frames of given shape to the AOI, with GCPs, water level and camera position.
+    The table is derived once with OpenRiverCam.cv.orthorectification on the pixel coordinates of the frame, and kept
+    in a least recently used cache, keyed by a hash of the geometry.
+
+    :param camera_config: dict, camera configuration with gcps, lensPosition, aoi and resolution
+    :param h_a: float, actual water level
+    :param img_shape: tuple, shape of frames
+    :param logger=logging: logger-object
+    :return: map1, map2 (remap table in fixed-point representation, see cv2.remap) and geotransform of projected frames
+    """
+    geometry = camera_config["aoi"]["bbox"]["features"][0]["geometry"]
+    key = hashlib.sha1(
+        json.dumps(
+            [
+                camera_config["gcps"],
+                camera_config["lensPosition"],
+                h_a,
+                geometry,
+                camera_config["resolution"],
+                list(img_shape[:2]),
+            ],
+            sort_keys=True,
+        ).encode()
+    ).hexdigest()
+    if key in _remap_cache:
+        _remap_cache.move_to_end(key)
+        logger.debug(f"Using cached remap table {key}")
+        return _remap_cache[key]
+    logger.debug(f"Computing remap table {key}")
+    bbox = shape(geometry)  # extract the one and only geometry from geojson
+    rows, cols = img_shape[:2]
+    # pixel coordinates, shifted by one so that areas outside the frame (filled with zeros) map outside the frame
+    xs, ys = np.meshgrid(
+        np.arange(1, cols + 1, dtype=np.float32), np.arange(1, rows + 1, dtype=np.float32)
+    )
+    (map_x, transform), (map_y, _) = [
+        OpenRiverCam.cv.orthorectification(
+            img=coords,
             lensPosition=camera_config["lensPosition"],
-            h_a=movie["h_a"],
+            h_a=h_a,
             bbox=bbox,
             resolution=camera_config["resolution"],
             **camera_config["gcps"],
         )
-        if len(corr_img.shape) == 3:
-            # RGB image
-            raster = np.int8(reshape_as_raster(corr_img))
-        else:
-            # b-w image (0-255) just add an axis
-            raster = np.int8(np.expand_dims(corr_img, axis=0))
-        # write to temporary file
-        OpenRiverCam.io.to_geotiff(
-            "temp.tif",
-            raster,
-            transform,
-            crs=camera_config["site"]["crs"],
-            compress="deflate",
-        )
-        # Put file in bucket
-        s3.Bucket(bucket).upload_file("temp.tif", dest_fn)
-        n += 1
-    # finally write last frame as .jpg for front end and write geotransform as .csv
+        for coords in [xs, ys]
+    ]
+    map1, map2 = cv2.convertMaps(map_x - 1, map_y - 1, cv2.CV_16SC2)
+    _remap_cache[key] = map1, map2, transform
+    if len(_remap_cache) > REMAP_CACHE_SIZE:
+        _remap_cache.popitem(last=False)
+    return _remap_cache[key]
+
+
+def _write_geotiff(fn, corr_img, transform, crs):
+    """
+    Write a projected frame to a deflate-compressed GeoTIFF file
+
+    :param fn: str, local file name
+    :param corr_img: np.ndarray, projected image, b-w (rows x cols) or RGB (rows x cols x 3)
+    :param transform: geotransform of the projected image
+    :param crs: int, EPSG code of the projection
+    :return: None
+    """
+    if len(corr_img.shape) == 3:
+        # RGB image
+        raster = np.int8(reshape_as_raster(corr_img))
+    else:
+        # b-w image (0-255) just add an axis
+        raster = np.int8(np.expand_dims(corr_img, axis=0))
+    OpenRiverCam.io.to_geotiff(
+        fn,
+        raster,
+        transform,
+        crs=crs,
+        compress="deflate",
+    )
+
+
+def _write_preview(bucket, corr_img, transform):
+    """
+    Write a projected frame as .jpg for front end and its geotransform to bucket
+
+    :param bucket: str, name of bucket
+    :param corr_img: np.ndarray, projected image
+    :param transform: geotransform of the projected image
+    :return: None
+    """
+    s3 = utils.get_s3()
     dest_fn = "reprojection_preview.jpg"
     trans_fn = "reprojection_preview.transform"  # file name for geotransform
     ret, im_en = cv2.imencode(".jpg", corr_img)
@@ -147,9 +383,46 @@ def extract_project_frames(movie, prefix="proj", logger=logging):
     buf = io.BytesIO(str(transform).encode())
     buf.seek(0)
     s3.Object(bucket, trans_fn).put(Body=buf)
-    # clean up of temp file
-    os.remove(fn)
-    logger.info(f"{fn} successfully reprojected into frames in {bucket}")
+
+
+def _write_manifest(bucket, prefix, frames, shape, transform, crs):
+    """
+    Write manifest of projected frames to bucket as {prefix}_manifest.json, so that the frames can be found without
+    listing the bucket
+
+    :param bucket: str, name of bucket
+    :param prefix: str, prefix of file names of projected frames
+    :param frames: list of dicts with name (key) and time offset in milliseconds (ms) of projected frames, in order
+    :param shape: tuple, shape of projected frames
+    :param transform: geotransform of projected frames
+    :param crs: int, EPSG code of the projection
+    :return: None
+    """
+    s3 = utils.get_s3()
+    manifest = {
+        "frames": frames,
+        "shape": list(shape),
+        "transform": list(transform)[:6],
+        "crs": crs,
+    }
+    s3.Object(bucket, f"{prefix}_manifest.json").put(Body=json.dumps(manifest).encode())
+
+
+def _read_manifest(bucket, prefix):
+    """
+    Read manifest of projected frames from bucket, see _write_manifest
+
+    :param bucket: str, name of bucket
+    :param prefix: str, prefix of file names of projected frames
+    :return: dict, with frames, shape, transform and crs
+    """
+    s3 = utils.get_s3()
+    try:
+        return json.loads(s3.Object(bucket, f"{prefix}_manifest.json").get()["Body"].read())
+    except s3.meta.client.exceptions.NoSuchKey:
+        raise ValueError(
+            f"No manifest of projected frames with prefix {prefix} found in {bucket}, run extract_project_frames first"
+        )
 
 
 def get_aoi(camera_config, logger=logging):
@@ -183,216 +456,565 @@ def get_aoi(camera_config, logger=logging):
     return bbox_json
 
 
-def compute_piv(movie, prefix="proj", piv_kwargs={}, logger=logging):
+def compute_piv(
+    movie,
+    prefix="proj",
+    piv_kwargs={},
+    stride=1,
+    lag=1,
+    n_workers=1,
+    prefetch=4,
+    frame_stack=False,
+    velocity_format=velocity.FORMAT,
+    force=False,
+    logger=logging,
+):
     """
     compute velocities over frame pairs, choosing frame interval, start / end frame.
 
     :param movie: dict, contains file dictionary and camera_config
     :param prefix: str, prefix of geotiff files assumed to be present in bucket
     :param piv_kwargs: str, arguments passed to piv algorithm, parameters are defined in docstring of
-           openpiv.pyprocess.extended_search_area_piv
+           openpiv.pyprocess.extended_search_area_piv. May also contain stride and lag
+    :param stride: int, only every stride-th frame pair is used (default: 1)
+    :param lag: int, frame n is paired with frame n + lag (default: 1)
+    :param n_workers: int, number of worker processes over which frame pairs are distributed
+    :param prefetch: int, number of frames that are downloaded and read ahead, while velocities are computed
+    :param frame_stack: bool, if True, projected frames are kept in a memory-mapped frame stack on local disk, and read
+        from there instead of the bucket when velocities of the same projected frames are computed again
+    :param velocity_format: str, "netcdf" for a single NetCDF file, or "zarr" for a chunked Zarr store
+    :param force: bool, if True, velocities are computed even if they are up to date in the bucket
     :param logger: logger object
     :return: None
     """
-    var_names = ["v_x", "v_y", "s2n", "corr"]
-    var_attrs = [
-        {
-            "standard_name": "sea_water_x_velocity",
-            "long_name": "Flow element center velocity vector, x-component",
-            "units": "m s-1",
-            "coordinates": "lon lat",
-        },
-        {
-            "standard_name": "sea_water_y_velocity",
-            "long_name": "Flow element center velocity vector, y-component",
-            "units": "m s-1",
-            "coordinates": "lon lat",
-        },
-        {
-            "standard_name": "ratio",
-            "long_name": "signal to noise ratio",
-            "units": "",
-            "coordinates": "lon lat",
-        },
-        {
-            "standard_name": "correlation_coefficient",
-            "long_name": "correlation coefficient between frames",
-            "units": "",
-            "coordinates": "lon lat",
-        },
-    ]
-    encoding = {var: {"zlib": True} for var in var_names}
-    start_time = datetime.strptime(movie["timestamp"], "%Y-%m-%dT%H:%M:%SZ")
-    resolution = movie["camera_config"]["resolution"]
-    aoi_window_size = movie["camera_config"]["aoi_window_size"]
-    # open S3 bucket
-    s3 = utils.get_s3()
-    n = 0
     logger.info(
         f"Computing velocities from projected frames in {movie['file']['bucket']}"
     )
-    # open file from bucket in memory
     bucket = movie["file"]["bucket"]
-    # get files with the right prefix
-    fns = s3.Bucket(bucket).objects.filter(Prefix=prefix)
-    frame_b = None
-    ms = None
-    time, v_x, v_y, s2n, corr = [], [], [], [], []
-    for n, fn in enumerate(fns):
-        # store previous time offset
-        _ms = ms
-        # determine time offset of frame from filename
-        ms = timedelta(milliseconds=int(fn.key[-10:-4]))
-        frame_a = frame_b
-        # buf = io.BytesIO()
-        fn.Object().download_file("temp.tif")
-        # buf.seek(0)
-        frame_b = OpenRiverCam.piv.imread("temp.tif")
-        # rewind to beginning of file
-        if (frame_a is not None) and (frame_b is not None):
-            # we have two frames in memory, now estimate velocity
-            logger.debug(f"Processing frame {n}")
-            # determine time difference dt between frames
-            dt = (ms - _ms).total_seconds()
-            cols, rows, _v_x, _v_y, _s2n, _corr = OpenRiverCam.piv.piv(
-                frame_a,
-                frame_b,
-                res_x=resolution,
-                res_y=resolution,
-                dt=dt,
-                search_area_size=aoi_window_size,
-                **piv_kwargs,
+    key = velocity.filename("velocity", velocity_format)
+    record = _get_record(bucket, prefix)
+    stack_dir = stack.path(bucket, prefix)
+    frames = None
+    if frame_stack:
+        # run keeps projected frames in a frame stack only, without GeoTIFF files in the bucket
+        for stack_record in [record, _get_record(bucket, f"{prefix}_stack")]:
+            if stack_record is not None:
+                frames = stack.open_stack(stack_dir, stack_record["hash"])
+            if frames is not None:
+                record = stack_record
+                break
+    input_hash = _velocity_hash(record, movie, piv_kwargs, stride, lag)
+    if not force and _up_to_date(bucket, key, input_hash, logger=logger):
+        return
+    projection_hash = record["hash"] if record is not None else None
+    write_stack = False
+    if frames is not None:
+        # frames are sliced from the local frame stack, without copies
+        frames, manifest = frames
+        logger.info(f"Reading {len(frames)} projected frames from frame stack in {stack_dir}")
+        frames = zip((timedelta(milliseconds=ms) for ms in manifest["times"]), stack.refs(frames))
+        manifest["shape"] = manifest["shape"][1:]
+    else:
+        # get frames, their shape and geotransform from the manifest written by extract_project_frames
+        manifest = _read_manifest(bucket, prefix)
+        frames = _read_projected_frames(bucket, manifest["frames"], prefetch=prefetch)
+        # frames are kept for a next time, if the inputs of the projected frames are known
+        write_stack = frame_stack and projection_hash is not None
+    with utils.scratch_dir() as tmp, _stack_writer(write_stack, stack_dir, projection_hash) as writer:
+        grid_fn = os.path.join(tmp, "grid.tif")
+        _write_geotiff(
+            grid_fn, np.zeros(manifest["shape"], dtype=np.uint8), Affine(*manifest["transform"]), manifest["crs"]
+        )
+        pairs = _piv(
+            movie,
+            _stack_frames(frames, writer),
+            piv_kwargs=piv_kwargs,
+            stride=stride,
+            lag=lag,
+            n_workers=n_workers,
+            logger=logger,
+        )
+        _write_velocity(movie, pairs, grid_fn, velocity_format=velocity_format, logger=logger)
+        if writer is not None:
+            writer.close(Affine(*manifest["transform"]), manifest["crs"])
+    _set_record(bucket, key, input_hash)
+
+
+def _stack_writer(frame_stack, stack_dir, input_hash):
+    """
+    Get writer of a frame stack, or a context without writer if frames are not kept in a frame stack
+
+    :param frame_stack: bool, if True, frames are kept in a frame stack
+    :param stack_dir: str, directory of frame stack
+    :param input_hash: str, hash of inputs of projected frames
+    :return: context manager returning stack.StackWriter or None
+    """
+    if frame_stack:
+        return stack.StackWriter(stack_dir, input_hash)
+    return contextlib.nullcontext()
+
+
+def _stack_frames(frames, writer=None):
+    """
+    Pass on frames, while appending them to a frame stack
+
+    :param frames: iterable of tuples (ms, frame) with time offset (timedelta) and frame (np.ndarray)
+    :param writer: stack.StackWriter or None, if None, frames are only passed on
+    :return: generator of tuples (ms, frame)
+    """
+    for ms, img in frames:
+        if writer is not None:
+            writer.append(int(ms / timedelta(milliseconds=1)), img)
+        yield ms, img
+
+
+def _read_projected_frames(bucket, frames, prefetch=4):
+    """
+    Generator of projected frames, read from GeoTIFF files in bucket. The next frames are downloaded and read in
+    background threads, while the current frames are processed.
+
+    :param bucket: str, name of bucket
+    :param frames: list of dicts with name (key) and time offset in milliseconds (ms) of GeoTIFF files, as listed in
+        manifest
+    :param prefetch: int, maximum number of frames read ahead
+    :return: generator of tuples (ms, frame) with time offset (timedelta) of frame and frame (np.ndarray)
+    """
+    def read(frame):
+        # threads share the connections of get_s3, and make their own bucket objects
+        fn = os.path.join(tmp, frame["key"])
+        utils.get_s3().Bucket(bucket).download_file(frame["key"], fn)
+        img = OpenRiverCam.piv.imread(fn)
+        os.remove(fn)
+        if img.dtype == np.int8:
+            # GeoTIFFs store the uint8 frames as int8, the same bytes are passed to piv as uint8, as run does
+            img = img.view(np.uint8)
+        return timedelta(milliseconds=frame["ms"]), img
+
+    with utils.scratch_dir() as tmp, concurrent.futures.ThreadPoolExecutor(max(prefetch, 1)) as executor:
+        for ms, img in utils.ordered_map(executor, read, frames, max_pending=max(prefetch, 1)):
+            yield ms, img
+
+
+def _piv(movie, frames, piv_kwargs={}, stride=1, lag=1, n_workers=1, logger=logging):
+    """
+    Generator of velocities over pairs of frames.
+
+    :param movie: dict, contains file dictionary and camera_config
+    :param frames: iterable of tuples (ms, frame) with time offset (timedelta) of frame and frame (np.ndarray)
+    :param piv_kwargs: str, arguments passed to piv algorithm, parameters are defined in docstring of
+           openpiv.pyprocess.extended_search_area_piv. May also contain stride and lag, which then override the
+           stride and lag arguments
+    :param stride: int, only every stride-th frame pair is used
+    :param lag: int, frame n is paired with frame n + lag
+    :param n_workers: int, number of worker processes over which frame pairs are distributed
+    :param logger: logger object
+    :return: generator of tuples (time, cols, rows, v_x, v_y, s2n, corr) per frame pair, in order of time
+    """
+    start_time = datetime.strptime(movie["timestamp"], "%Y-%m-%dT%H:%M:%SZ")
+    resolution = movie["camera_config"]["resolution"]
+    piv_kwargs = dict(piv_kwargs)
+    stride = int(piv_kwargs.pop("stride", stride))
+    lag = int(piv_kwargs.pop("lag", lag))
+    if stride < 1 or lag < 1:
+        raise ValueError(f"stride and lag must be positive integers, found stride={stride}, lag={lag}")
+    kwargs = {
+        "res_x": resolution,
+        "res_y": resolution,
+        "search_area_size": movie["camera_config"]["aoi_window_size"],
+        **piv_kwargs,
+    }
+
+    def pairs():
+        # last lag + 1 frames, the first one is paired with the last one
+        window = deque(maxlen=lag + 1)
+        for n, (ms, frame) in enumerate(frames):
+            window.append((ms, frame))
+            if n < lag or (n - lag) % stride != 0:
+                continue
+            _ms, frame_a = window[0]
+            if (frame_a is not None) and (frame is not None):
+                # we have two frames in memory, now estimate velocity
+                logger.debug(f"Processing frame {n - lag} with frame {n}")
+                # determine time difference dt between frames
+                dt = (ms - _ms).total_seconds()
+                yield start_time + ms, frame_a, frame, dt, kwargs
+
+    if n_workers > 1:
+        logger.info(f"Computing velocities with {n_workers} worker processes")
+        executor = concurrent.futures.ProcessPoolExecutor(n_workers)
+        results = utils.ordered_map(executor, _piv_pair, pairs(), max_pending=2 * n_workers)
+    else:
+        executor = None
+        results = map(_piv_pair, pairs())
+    try:
+        # results are returned in order of frame pairs
+        for result in results:
+            yield result
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def _piv_pair(job):
+    """
+    compute velocities over one pair of frames
+
+    :param job: tuple (time, frame_a, frame_b, dt, kwargs) with time of pair, frames (np.ndarray or stack.FrameRef),
+        time difference between frames in seconds and arguments passed to OpenRiverCam.piv.piv
+    :return: time, cols, rows, v_x, v_y, s2n, corr
+    """
+    time, frame_a, frame_b, dt, kwargs = job
+    # frames of a frame stack are passed as references, and mapped in the worker process
+    frame_a, frame_b = stack.load(frame_a), stack.load(frame_b)
+    return (time, *OpenRiverCam.piv.piv(frame_a, frame_b, dt=dt, **kwargs))
+
+
+def _filter_temporal_block(job):
+    """
+    filter one block of grid cells of a velocity dataset over time
+
+    :param job: tuple (src, tmp, rows, cols, filter_temporal_kwargs), with local file of velocities, scratch directory,
+        rows and columns of the block and arguments passed to the filters
+    :return: xarray.Dataset, velocities of block, filtered over time
+    """
+    src, tmp, rows, cols, filter_temporal_kwargs = job
+    # OpenRiverCam reads the temporal filter input from file
+    fn = os.path.join(tmp, f"block_{rows.start}_{cols.start}.nc")
+    velocity.read_block(src, rows=rows, cols=cols).to_netcdf(fn)
+    try:
+        return OpenRiverCam.piv.filter_temporal(fn, **filter_temporal_kwargs).load()
+    finally:
+        os.remove(fn)
+
+
+def _filter_spatial_block(job):
+    """
+    filter one block of time steps of a velocity dataset over space
+
+    :param job: tuple (fn, times, filter_spatial_kwargs), with local file of velocities, time steps of the block and
+        arguments passed to the filters
+    :return: xarray.Dataset, velocities of block, filtered over space
+    """
+    fn, times, filter_spatial_kwargs = job
+    return OpenRiverCam.piv.filter_spatial(velocity.read_block(fn, times=times), **filter_spatial_kwargs).load()
+
+
+def _grid_coords(grid_fn, cols, rows):
+    """
+    Get coordinates of the PIV grid, reusing coordinates of earlier movies with the same grid
+
+    :param grid_fn: str, GeoTIFF of one projected frame
+    :param cols: np.ndarray, columns of PIV grid in projected frame
+    :param rows: np.ndarray, rows of PIV grid in projected frame
+    :return: xs, ys, lons, lats (np.ndarray)
+    """
+    with rasterio.open(grid_fn) as src:
+        geometry = [list(src.transform)[:6], src.crs.to_string(), src.shape]
+    key = hashlib.sha1(json.dumps(geometry).encode() + cols.tobytes() + rows.tobytes()).hexdigest()
+    if key in _grid_cache:
+        _grid_cache.move_to_end(key)
+        return _grid_cache[key]
+    coords = OpenRiverCam.io.convert_cols_rows(grid_fn, cols, rows)
+    _grid_cache[key] = coords
+    if len(_grid_cache) > REMAP_CACHE_SIZE:
+        _grid_cache.popitem(last=False)
+    return coords
+
+
+def _write_velocity(movie, pairs, grid_fn, velocity_format=velocity.FORMAT, logger=logging):
+    """
+    Write velocities over frame pairs to velocity.nc or velocity.zarr in bucket. Velocities are written while pairs are
+    computed, so that memory use does not depend on the amount of frame pairs.
+
+    :param movie: dict, contains file dictionary and camera_config
+    :param pairs: iterable of tuples (time, cols, rows, v_x, v_y, s2n, corr) per frame pair
+    :param grid_fn: str or file-like, GeoTIFF of one projected frame, used to retrieve coordinates of grid
+    :param velocity_format: str, "netcdf" for a single NetCDF file, or "zarr" for a chunked Zarr store
+    :param logger: logger object
+    :return: None
+    """
+    start_time = datetime.strptime(movie["timestamp"], "%Y-%m-%dT%H:%M:%SZ")
+    resolution = movie["camera_config"]["resolution"]
+    s3 = utils.get_s3()
+    bucket = movie["file"]["bucket"]
+    key = velocity.filename("velocity", velocity_format)
+    writer = None
+    with utils.scratch_dir() as tmp:
+        fn = os.path.join(tmp, key)
+        try:
+            for time, cols, rows, *arrays in pairs:
+                if writer is None:
+                    # prepare coordinates and local axes from the first frame pair
+                    xs, ys, lons, lats = _grid_coords(grid_fn, cols, rows)
+                    x, y = velocity.grid_axes(cols, rows, resolution)
+                    if velocity_format == "zarr":
+                        # chunks are written to the bucket directly
+                        writer = velocity.ZarrVelocityWriter(
+                            utils.get_zarr_store(bucket, key), start_time, x, y, xs, ys, lons, lats
+                        )
+                    else:
+                        writer = velocity.VelocityWriter(fn, start_time, x, y, xs, ys, lons, lats)
+                writer.append(time, arrays)
+        finally:
+            if writer is not None:
+                writer.close()
+        if velocity_format != "zarr":
+            # write to bucket
+            s3.Bucket(bucket).upload_file(fn, key, Config=utils.get_transfer_config())
+    logger.info(f"{key} successfully written in {bucket}")
+
+
+def _project_piv(
+    movie,
+    prefix="proj",
+    piv_kwargs={},
+    stride=1,
+    lag=1,
+    start_frame=None,
+    end_frame=None,
+    persist_frames=False,
+    frame_stack=False,
+    n_workers=1,
+    velocity_format=velocity.FORMAT,
+    force=False,
+    logger=logging,
+):
+    """
+    Project frames and compute velocities over frame pairs in one pass. Projected frames are handed over to the
+    velocity computation in memory, instead of through GeoTIFF files in the bucket.
+
+    :param movie: dict, movie information
+    :param prefix="proj": str, prefix of file names of projected frames, used in storage bucket
+    :param piv_kwargs: str, arguments passed to piv algorithm, parameters are defined in docstring of
+           openpiv.pyprocess.extended_search_area_piv. May also contain stride and lag
+    :param stride: int, only every stride-th frame pair is used
+    :param lag: int, frame n is paired with frame n + lag
+    :param start_frame: int, first frame of movie to use, None for the first frame of the movie
+    :param end_frame: int, last frame of movie to use (inclusive), None for the last frame of the movie
+    :param persist_frames: bool, if True, projected frames are also stored as GeoTIFF files in the bucket
+    :param frame_stack: bool, if True, projected frames are also kept in a memory-mapped frame stack on local disk, or
+        read from there if they were projected from the same inputs before
+    :param n_workers: int, number of worker processes over which frame pairs are distributed
+    :param velocity_format: str, "netcdf" for a single NetCDF file, or "zarr" for a chunked Zarr store
+    :param force: bool, if True, velocities are computed even if they are up to date in the bucket
+    :param logger: logger object
+    :return: None
+    """
+    bucket = movie["file"]["bucket"]
+    key = velocity.filename("velocity", velocity_format)
+    projection_hash = _projection_hash(movie, start_frame, end_frame)
+    input_hash = _velocity_hash({"hash": projection_hash}, movie, piv_kwargs, stride, lag)
+    if not force and _up_to_date(bucket, key, input_hash, logger=logger):
+        return
+    crs = movie["camera_config"]["site"]["crs"]
+    stack_dir = stack.path(bucket, prefix)
+    projected = {}
+
+    manifest = []
+    stacked = stack.open_stack(stack_dir, projection_hash) if frame_stack else None
+    if stacked is not None:
+        # frames were projected before, e.g. by an earlier run with other PIV arguments, the movie is not decoded
+        logger.info(f"Reading {len(stacked[0])} projected frames from frame stack in {stack_dir}")
+        source = _read_stack(*stacked)
+    else:
+        source = (
+            (n, int(_t * 1000), corr_img, transform)
+            for n, _t, corr_img, transform in _project_frames(
+                movie, start_frame=start_frame, end_frame=end_frame, logger=logger
             )
-            v_x.append(_v_x), v_y.append(_v_y), s2n.append(_s2n), corr.append(_corr)
-            time.append(start_time + ms)
-            os.remove("temp.tif")
-    # finally read GeoTiff transform from the first file
-    for fn in fns.limit(1):
-        logger.info(f"Retrieving coordinates of grid from {fn.key}")
-        buf = io.BytesIO()
-        fn.Object().download_fileobj(buf)
-        buf.seek(0)
-        xs, ys, lons, lats = OpenRiverCam.io.convert_cols_rows(buf, cols, rows)
-
-    # prepare local axes
-    spacing_x = np.diff(cols[0])[0]
-    spacing_y = np.diff(rows[:, 0])[0]
-    x = np.linspace(
-        resolution / 2 * spacing_x,
-        (len(cols[0]) - 0.5) * resolution * spacing_x,
-        len(cols[0]),
-    )
-    y = np.flipud(
-        np.linspace(
-            resolution / 2 * spacing_y,
-            (len(rows[:, 0]) - 0.5) * resolution * spacing_y,
-            len(rows[:, 0]),
         )
-    )
 
-    # prepare dataset
-    dataset = OpenRiverCam.io.to_dataset(
-        [v_x, v_y, s2n, corr],
-        var_names,
-        x,
-        y,
-        time=time,
-        lat=lats,
-        lon=lons,
-        xs=xs,
-        ys=ys,
-        attrs=var_attrs,
-    )
-    # write to file and to bucket
-    dataset.to_netcdf("temp.nc", encoding=encoding)
-    s3.Bucket(bucket).upload_file("temp.nc", "velocity.nc")
-    os.remove("temp.nc")
-    logger.info(f"velocity.nc successfully written in {bucket}")
+    def frames(uploader):
+        for n, ms, corr_img, transform in source:
+            if n == 0:
+                # keep first frame locally for the coordinates of the grid
+                _write_geotiff(grid_fn, corr_img, transform, crs)
+            if persist_frames:
+                dest_fn = "{:s}_{:04d}_{:06d}.tif".format(prefix, n, ms)
+                logger.debug(f"Write frame {n} in {dest_fn} to S3")
+                _write_geotiff(os.path.join(tmp, dest_fn), corr_img, transform, crs)
+                uploader.upload_file(os.path.join(tmp, dest_fn), dest_fn, remove=True)
+                manifest.append({"key": dest_fn, "ms": ms})
+            projected["img"], projected["transform"] = corr_img, transform
+            yield timedelta(milliseconds=ms), corr_img
+
+    logger.info(f"Computing velocities from projected frames of {movie['file']['identifier']}")
+    write_stack = frame_stack and stacked is None
+    with utils.scratch_dir() as tmp, utils.Uploader(bucket) as uploader, _stack_writer(
+        write_stack, stack_dir, projection_hash
+    ) as writer:
+        grid_fn = os.path.join(tmp, "grid.tif")
+        pairs = _piv(
+            movie,
+            _stack_frames(frames(uploader), writer),
+            piv_kwargs=piv_kwargs,
+            stride=stride,
+            lag=lag,
+            n_workers=n_workers,
+            logger=logger,
+        )
+        _write_velocity(movie, pairs, grid_fn, velocity_format=velocity_format, logger=logger)
+        uploader.flush()
+        if writer is not None:
+            writer.close(projected["transform"], crs)
+    # write last frame as .jpg for front end and write geotransform
+    _write_preview(bucket, projected["img"], projected["transform"])
+    if persist_frames:
+        _write_manifest(bucket, prefix, manifest, projected["img"].shape, projected["transform"], crs)
+        _set_record(bucket, prefix, projection_hash)
+    if write_stack:
+        # compute_piv finds the frame stack through this record, also without GeoTIFF files in the bucket
+        _set_record(bucket, f"{prefix}_stack", projection_hash)
+    _set_record(bucket, key, input_hash)
+
+
+def _read_stack(frames, meta):
+    """
+    Generator of projected frames from a frame stack, in the form of _project_frames
+
+    :param frames: np.memmap, frame stack, see stack.open_stack
+    :param meta: dict, meta data of frame stack, see stack.open_stack
+    :return: generator of tuples (n, ms, corr_img, transform) with frame number, time offset in milliseconds,
+        projected image and its geotransform
+    """
+    transform = Affine(*meta["transform"])
+    for n, ms in enumerate(meta["times"]):
+        yield n, ms, frames[n], transform
 
 
 def compute_q(
-    movie, v_corr=0.85, quantile=[0.05, 0.25, 0.5, 0.75, 0.95], logger=logging
+    movie,
+    v_corr=0.85,
+    quantile=[0.05, 0.25, 0.5, 0.75, 0.95],
+    velocity_format=velocity.FORMAT,
+    force=False,
+    logger=logging,
 ):
     """
     compute velocities over provided bathymetric cross section points, depth integrated velocities and river flow
-    over several quantiles.
+    over several quantiles. Several cross sections can be provided as a list of bathymetries, these are all
+    extracted from one read of the velocities.
 
-    :param movie: dict, contains file dictionary and camera_config
+    :param movie: dict, contains file dictionary and camera_config, "bathymetry" is a dict or list of dicts with
+        coordinates of cross sections
     :param v_corr: float (range: 0-1, typically close to 1), correction factor from surface to depth-average
            (default: 0.85)
     :param quantile: float or list of floats (range: 0-1)  (default: 0.5)
-    :return: None
+    :param velocity_format: str, "netcdf" for a single NetCDF file, or "zarr" for a chunked Zarr store
+    :param force: bool, if True, river flow is computed even if it is up to date in the bucket
+    :return: dict, river flow per quantile of first cross section, with river flow of all cross sections under
+        "transects" if a list of bathymetries is provided
     """
-    encoding = {}
-    # open S3 bucket
-    s3 = utils.get_s3()
-    logger.info(
-        f"Extracting cross section from velocities in {movie['file']['bucket']}"
-    )
-    # open file from bucket in memory
     bucket = movie["file"]["bucket"]
-    fn = "velocity_filter.nc"
-    s3.Bucket(bucket).download_file(fn, "temp.nc")
-
-    # retrieve velocities over cross section only (ds_points has time, points as dimension)
-    ds_points = OpenRiverCam.io.interp_coords(
-        "temp.nc", *zip(*movie["bathymetry"]["coords"])
+    input_hash = _stage_hash(
+        _get_record(bucket, velocity.filename("velocity_filter", velocity_format)),
+        movie["bathymetry"],
+        v_corr,
+        quantile,
+        movie["camera_config"]["gcps"]["z_0"],
+        movie["h_a"],
     )
+    record = _up_to_date(bucket, "Q.nc", input_hash, logger=logger)
+    if not force and record:
+        return record["result"]
+    bathymetries = movie["bathymetry"]
+    if isinstance(bathymetries, dict):
+        bathymetries = [bathymetries]
+    with utils.scratch_dir() as tmp:
+        encoding = {}
+        # open S3 bucket
+        s3 = utils.get_s3()
+        logger.info(
+            f"Extracting {len(bathymetries)} cross section(s) from velocities in {movie['file']['bucket']}"
+        )
+        # open filtered velocities from bucket
+        fn = velocity.open_velocity(bucket, "velocity_filter", tmp, velocity_format)
 
-    # add the effective velocity perpendicular to cross-section
-    ds_points["v_eff"] = OpenRiverCam.piv.vector_to_scalar(
-        ds_points["v_x"], ds_points["v_y"]
-    )
+        # retrieve velocities over all cross sections at once (ds_all has time, points as dimension)
+        coords = [coord for bathymetry in bathymetries for coord in bathymetry["coords"]]
+        ds_all = OpenRiverCam.io.interp_coords(fn, *zip(*coords))
 
-    # get the required quantiles
-    ds_points = ds_points.quantile(quantile, dim="time")
+        transects = []
+        start = 0
+        for n, bathymetry in enumerate(bathymetries):
+            # points of the n-th cross section
+            ds_points = ds_all.isel(points=slice(start, start + len(bathymetry["coords"])))
+            start += len(bathymetry["coords"])
 
-    # fill missing velocities with logarithmic profile fit
-    ds_points["v_eff_fill"] = OpenRiverCam.piv.velocity_fill(ds_points["zcoords"],
-                                                             ds_points["v_eff"],
-                                                             movie["camera_config"]["gcps"]["z_0"],
-                                                             movie["h_a"]
-                                                             )
+            # add the effective velocity perpendicular to cross-section
+            ds_points["v_eff"] = OpenRiverCam.piv.vector_to_scalar(
+                ds_points["v_x"], ds_points["v_y"]
+            )
 
-    # integrate over depth with vertical correction
-    ds_points["q"] = OpenRiverCam.piv.depth_integrate(
-        ds_points["zcoords"],
-        ds_points["v_eff_fill"],
-        movie["camera_config"]["gcps"]["z_0"],
-        movie["h_a"],
-        v_corr=v_corr,
-    )
+            # get the required quantiles
+            ds_points = ds_points.quantile(quantile, dim="time")
 
-    # integrate over the width of the cross-section
-    Q = OpenRiverCam.piv.integrate_flow(ds_points["q"])
+            # fill missing velocities with logarithmic profile fit
+            ds_points["v_eff_fill"] = OpenRiverCam.piv.velocity_fill(ds_points["zcoords"],
+                                                                     ds_points["v_eff"],
+                                                                     movie["camera_config"]["gcps"]["z_0"],
+                                                                     movie["h_a"]
+                                                                     )
 
-    # extract a callback from Q
-    Q_dict = {
-        "discharge_q{:02d}".format(int(float(q) * 100)): float(Q.sel(quantile=q))
-        for q in Q["quantile"]
-    }
+            # integrate over depth with vertical correction
+            ds_points["q"] = OpenRiverCam.piv.depth_integrate(
+                ds_points["zcoords"],
+                ds_points["v_eff_fill"],
+                movie["camera_config"]["gcps"]["z_0"],
+                movie["h_a"],
+                v_corr=v_corr,
+            )
+
+            # integrate over the width of the cross-section
+            Q = OpenRiverCam.piv.integrate_flow(ds_points["q"])
 
-    # overwrite gridded netCDF with cross section netCDF
-    ds_points.to_netcdf("temp.nc", encoding=encoding)
-    s3.Bucket(bucket).upload_file("temp.nc", "q_depth.nc")
-    logger.info(f"q_depth.nc successfully written in {bucket}")
+            # extract a callback from Q
+            Q_dict = {
+                "discharge_q{:02d}".format(int(float(q) * 100)): float(Q.sel(quantile=q))
+                for q in Q["quantile"]
+            }
+            if "id" in bathymetry:
+                Q_dict["bathymetry_id"] = bathymetry["id"]
+            transects.append(Q_dict)
 
-    # overwrite gridded netCDF with cross section netCDF
-    Q.to_netcdf("temp.nc", encoding=encoding)
-    s3.Bucket(bucket).upload_file("temp.nc", "Q.nc")
+            # first cross section keeps the original file names
+            suffix = f"_{n}" if n > 0 else ""
 
-    os.remove("temp.nc")
-    logger.info(f"Q.nc successfully written in {bucket}")
-    return Q_dict
+            # write cross section netCDF
+            ds_points.to_netcdf(os.path.join(tmp, f"q_depth{suffix}.nc"), encoding=encoding)
+            s3.Bucket(bucket).upload_file(os.path.join(tmp, f"q_depth{suffix}.nc"), f"q_depth{suffix}.nc")
+            logger.info(f"q_depth{suffix}.nc successfully written in {bucket}")
+
+            # write discharge netCDF
+            Q.to_netcdf(os.path.join(tmp, f"Q{suffix}.nc"), encoding=encoding)
+            s3.Bucket(bucket).upload_file(os.path.join(tmp, f"Q{suffix}.nc"), f"Q{suffix}.nc")
+            logger.info(f"Q{suffix}.nc successfully written in {bucket}")
+
+        Q_dict = {key: value for key, value in transects[0].items() if key.startswith("discharge_")}
+        if isinstance(movie["bathymetry"], list):
+            Q_dict["transects"] = transects
+        _set_record(bucket, "Q.nc", input_hash, result=Q_dict)
+        return Q_dict
 
 
 def filter_piv(
-    movie, filter_temporal_kwargs={}, filter_spatial_kwargs={}, logger=logging
+    movie,
+    filter_temporal_kwargs={},
+    filter_spatial_kwargs={},
+    n_workers=1,
+    band_memory=velocity.BAND_MEMORY,
+    velocity_format=velocity.FORMAT,
+    force=False,
+    logger=logging,
 ):
     """
     Filters a PIV velocity dataset (derived with compute_piv) with several temporal and spatial filter. This removes
     noise, isolated velocities in space and time, and moving features that are not likely to be water related.
     Input keyword arguments to the filters can be provided in the request, through several dictionaries.
+    Temporal filters only use values of the same grid cell, and spatial filters only values of the same time step.
+    Therefore, the dataset is filtered in two passes, so that memory use does not depend on the size of the dataset:
+    over time in blocks of grid cells with all their time steps, and over space in blocks of time steps of the whole
+    grid.
 
     :param movie: dict, contains file dictionary and camera_config
     :param filter_temporal_kwargs: dict with the following possible kwargs for temporal filtering
@@ -427,47 +1049,178 @@ def filter_piv(
             tolerance=0.7 -- amount of standard deviations tolerance
             stride=1 -- int, stride used to determine relevant neighbours
 
+    :param n_workers: int, number of worker processes over which blocks are distributed
+    :param band_memory: float, memory budget in MB of one block of grid cells or time steps
+    :param velocity_format: str, "netcdf" for a single NetCDF file, or "zarr" for a chunked Zarr store
+    :param force: bool, if True, velocities are filtered even if they are up to date in the bucket
     :param logger: logging object
     :return:
     """
-
-    # open S3 bucket
-    s3 = utils.get_s3()
-    logger.info(f"Filtering surface velocities in {movie['file']['bucket']}")
-    # open file from bucket in memory
     bucket = movie["file"]["bucket"]
-    fn = "velocity.nc"
-    s3.Bucket(bucket).download_file(fn, "temp.nc")
-    logger.debug("applying temporal filters")
-    ds = OpenRiverCam.piv.filter_temporal("temp.nc", **filter_temporal_kwargs)
-    logger.debug("applying spatial filters")
-    ds = OpenRiverCam.piv.filter_spatial(ds, **filter_spatial_kwargs)
+    key = velocity.filename("velocity_filter", velocity_format)
+    input_hash = _stage_hash(
+        _get_record(bucket, velocity.filename("velocity", velocity_format)),
+        filter_temporal_kwargs,
+        filter_spatial_kwargs,
+    )
+    if not force and _up_to_date(bucket, key, input_hash, logger=logger):
+        return
 
-    # remove original file
-    os.remove("temp.nc")
-    encoding = {var: {"zlib": True} for var in ds}
-    # write gridded netCDF with filtered velocities netCDF
-    ds.to_netcdf("temp.nc", encoding=encoding)
-    s3.Bucket(bucket).upload_file("temp.nc", "velocity_filter.nc")
-    os.remove("temp.nc")
-    logger.info(f"velocity_filter.nc successfully written in {bucket}")
+    with utils.scratch_dir() as tmp:
+        logger.info(f"Filtering surface velocities in {movie['file']['bucket']}")
+        # open velocities from bucket
+        src = velocity.open_velocity(bucket, "velocity", tmp, velocity_format)
+        cell_blocks = velocity.cell_blocks(src, memory=band_memory, logger=logger)
+        time_blocks = velocity.time_blocks(src, memory=band_memory, logger=logger)
+        logger.debug(
+            f"filtering velocities over time in {len(cell_blocks)} blocks of grid cells, and over space in "
+            f"{len(time_blocks)} blocks of time steps"
+        )
+        if n_workers > 1:
+            logger.info(f"Filtering velocities with {n_workers} worker processes")
+            # forked workers would inherit the open NetCDF files of this process, and read stale copies of them
+            executor = concurrent.futures.ProcessPoolExecutor(
+                n_workers, mp_context=multiprocessing.get_context("forkserver")
+            )
+            map_blocks = functools.partial(utils.ordered_map, executor, max_pending=n_workers)
+        else:
+            executor = None
+            map_blocks = map
+        blocks_fn = os.path.join(tmp, "velocity_blocks.nc")
+        temporal_fn = os.path.join(tmp, "velocity_temporal.nc")
+        fn = os.path.join(tmp, "velocity_filter.nc")
+        try:
+            # chunks of the intermediate files fit both the blocks of grid cells and the blocks of time steps
+            rows, cols = cell_blocks[0]
+            chunksizes = (time_blocks[0].stop - time_blocks[0].start, rows.stop - rows.start, cols.stop - cols.start)
+            # velocities are copied once to a local file, so that a Zarr store is read from the bucket only once, and
+            # every block of grid cells only reads its own chunks
+            with velocity.BlockWriter(blocks_fn, src, chunksizes) as writer:
+                for times in time_blocks:
+                    writer.write(velocity.read_block(src, times=times), times=times)
+            jobs = ((blocks_fn, tmp, rows, cols, filter_temporal_kwargs) for rows, cols in cell_blocks)
+            with velocity.BlockWriter(temporal_fn, src, chunksizes) as writer:
+                for (rows, cols), block in zip(cell_blocks, map_blocks(_filter_temporal_block, jobs)):
+                    writer.write(block, rows=rows, cols=cols)
+            # write gridded filtered velocities, one chunk per time step as the velocities of compute_piv
+            jobs = ((temporal_fn, times, filter_spatial_kwargs) for times in time_blocks)
+            with velocity.BlockWriter(fn, src, (1, None, None)) as writer:
+                for times, block in zip(time_blocks, map_blocks(_filter_spatial_block, jobs)):
+                    writer.write(block, times=times)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        velocity.upload_velocity(fn, bucket, "velocity_filter", velocity_format)
+        _set_record(bucket, key, input_hash)
+        logger.info(f"{key} successfully written in {bucket}")
 
 
-def run(movie, piv_kwargs={}, logger=logging):
+def run(
+    movie,
+    piv_kwargs={},
+    stride=1,
+    lag=1,
+    start_frame=None,
+    end_frame=None,
+    persist_frames=False,
+    frame_stack=False,
+    n_workers=1,
+    velocity_format=velocity.FORMAT,
+    force=False,
+    logger=logging,
+):
     """
-    Execute steps of project frames, compute_piv, filter_piv and compute_q.
+    Execute steps of project frames, compute_piv, filter_piv and compute_q. Projected frames are streamed directly
+    into the velocity computation. Finished steps are recorded in a checkpoint, with the hash of the record of their
+    result, so that a run that failed resumes from the first unfinished step, as long as the results of the finished
+    steps were not replaced or removed in the meantime. Steps of which the results are up to date in the bucket are
+    skipped.
 
     :param movie: dict, movie information
+    :param piv_kwargs: dict, arguments passed to piv algorithm, see compute_piv
+    :param stride: int, only every stride-th frame pair is used (default: 1)
+    :param lag: int, frame n is paired with frame n + lag (default: 1)
+    :param start_frame: int, first frame of movie to use, None for the first frame of the movie (default: None)
+    :param end_frame: int, last frame of movie to use (inclusive), None for the last frame of the movie (default: None)
+    :param persist_frames: bool, if True, projected frames are also stored as GeoTIFF files in the bucket (default: False)
+    :param frame_stack: bool, if True, projected frames are also kept in a memory-mapped frame stack on local disk, which
+        a next run or compute_piv reads instead of decoding the movie again (default: False)
+    :param n_workers: int, number of worker processes over which frame pairs and filtered bands are distributed
+        (default: 1)
+    :param velocity_format: str, "netcdf" for single NetCDF files, or "zarr" for chunked Zarr stores
+    :param force: bool, if True, all steps are executed, also if their results are up to date (default: False)
     :param logger=logging: logger-object
     :return: None
     """
 
-    extract_project_frames(movie, logger=logger)
-    compute_piv(movie, piv_kwargs=piv_kwargs, logger=logger)
-    filter_piv(movie, logger=logger)
-    Q = compute_q(movie, logger=logger)
-    # Clean up .tif files
-    _clean_files(movie["file"]["bucket"])
+    bucket = movie["file"]["bucket"]
+    run_hash = _stage_hash(
+        {"hash": _projection_hash(movie, start_frame, end_frame)},
+        piv_kwargs,
+        stride,
+        lag,
+        velocity_format,
+        movie["camera_config"]["aoi_window_size"],
+        movie["timestamp"],
+        movie["bathymetry"],
+    )
+    checkpoint = _get_record(bucket, "run")
+    if force or checkpoint is None or checkpoint["hash"] != run_hash:
+        checkpoint = {"hash": run_hash, "result": {}}
+    elif checkpoint["result"]:
+        logger.info(f"Resuming run of movie {movie['id']}, finished steps: {', '.join(checkpoint['result'])}")
+    steps = [
+        (
+            "velocity",
+            velocity.filename("velocity", velocity_format),
+            functools.partial(
+                _project_piv,
+                movie,
+                piv_kwargs=piv_kwargs,
+                stride=stride,
+                lag=lag,
+                start_frame=start_frame,
+                end_frame=end_frame,
+                persist_frames=persist_frames,
+                frame_stack=frame_stack,
+                n_workers=n_workers,
+                velocity_format=velocity_format,
+                force=force,
+                logger=logger,
+            ),
+        ),
+        (
+            "filter",
+            velocity.filename("velocity_filter", velocity_format),
+            functools.partial(
+                filter_piv,
+                movie,
+                n_workers=n_workers,
+                velocity_format=velocity_format,
+                force=force,
+                logger=logger,
+            ),
+        ),
+        (
+            "discharge",
+            "Q.nc",
+            functools.partial(compute_q, movie, velocity_format=velocity_format, force=force, logger=logger),
+        ),
+    ]
+    results = {}
+    for name, key, step in steps:
+        # a finished step is skipped if the record of its result is still the one of the checkpoint
+        record = _up_to_date(bucket, key, checkpoint["result"].get(name), logger=logger)
+        if record is not None:
+            logger.debug(f"Step {name} already finished, skipping")
+            results[name] = record["result"]
+            continue
+        results[name] = step()
+        # record finished step, so that a next attempt can resume from here
+        record = _get_record(bucket, key)
+        checkpoint["result"][name] = record["hash"] if record is not None else None
+        _set_record(bucket, "run", run_hash, result=checkpoint["result"])
+    Q = results["discharge"]
     # TODO: Return the discharge value in the processing callback to be stored in the database.
     logger.debug(f"Performing callback with discharge value {Q}")
     # API request to confirm movie run is finished.
@@ -482,16 +1235,38 @@ def run(movie, piv_kwargs={}, logger=logging):
     logger.info(f"Full run succesfull for movie {movie['id']}")
 
 
-def _clean_files(bucket):
+def run_batch(movies, on_finished=None, logger=logging, **kwargs):
     """
-        Clean Up Movie .tif files
+    Execute run for several movies of the same camera configuration, one after the other in the same worker. The grid
+    coordinates of the camera configuration are computed for the first movie and reused for the next ones. Remap
+    tables depend on the water level of each movie, and are only reused by movies with the same water level. Every
+    movie gets its own callback, a failed movie is reported and does not stop the batch.
 
-        :param movie: bucket
-        :return: None
+    :param movies: list of dicts, movie information of each movie
+    :param on_finished: function, called with the id of every movie of which the result or error was reported, e.g.
+        to keep track of the unfinished movies of the batch (default: None)
+    :param logger=logging: logger-object
+    :param kwargs: dict, further arguments passed to run, see run
+    :return: None
     """
-    s3 = utils.get_s3()
-    prefix = "proj"
-    s3.Bucket(bucket).objects.filter(Prefix=prefix).delete()
+    config_ids = set(movie["camera_config"].get("id") for movie in movies)
+    if len(config_ids) > 1:
+        logger.warning(f"Movies of {len(config_ids)} different camera configurations in batch, geometry is not shared")
+    failed = []
+    for n, movie in enumerate(movies):
+        logger.info(f"Run movie {movie['id']} ({n + 1}/{len(movies)}) of batch")
+        try:
+            run(movie, logger=logger, **kwargs)
+        except Exception as e:
+            logger.error(f"Run of movie {movie['id']} failed with error {e}")
+            failed.append(movie["id"])
+            requests.post(
+                "{}/processing/error/{}".format(os.getenv("ORC_API_URL"), movie["id"]),
+                json={"error_message": str(e)},
+            )
+        if on_finished is not None:
+            on_finished(movie["id"])
+    logger.info(f"Batch run finished, {len(movies) - len(failed)} of {len(movies)} movies succesfull")
 
 
 def run_camera_config(movie, logger=logging):
@@ -515,4 +1290,124 @@ def run_camera_config(movie, logger=logging):
     #     "http://localhost/api/processing/get_aoi/{:d}".format(movie['camera_config']["id"]),
     #     json=bbox_json,
     # )
-    logger.info(f"Camera config run succesfull for configuration {movie['camera_config']['id']}")
\ No newline at end of file
+    logger.info(f"Camera config run succesfull for configuration {movie['camera_config']['id']}")
+
+
+def _stage_hash(record, *inputs):
+    """
+    Hash of the inputs of a processing step, combined with the record of the result of the previous step
+
+    :param record: dict, record of the result of the previous step (see _get_record), None if not available
+    :param inputs: json serializable inputs of the processing step
+    :return: str, hash, None if record of previous step is not available
+    """
+    if record is None:
+        return None
+    return hashlib.sha1(
+        json.dumps([record["hash"], *inputs], sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def _projection_hash(movie, start_frame=None, end_frame=None):
+    """
+    Hash of the inputs of projecting frames: the movie file, the window of frames and the geometry of the camera
+    configuration
+
+    :param movie: dict, movie information
+    :param start_frame: int, first frame of movie, None for the first frame of the movie
+    :param end_frame: int, last frame of movie, None for the last frame of the movie
+    :return: str, hash
+    """
+    s3 = utils.get_s3()
+    camera_config = movie["camera_config"]
+    # the entity tag changes when a movie with the same name is uploaded again
+    e_tag = s3.Object(movie["file"]["bucket"], movie["file"]["identifier"]).e_tag
+    return _stage_hash(
+        {"hash": e_tag},
+        [start_frame, end_frame],
+        camera_config["camera_type"]["lensParameters"],
+        camera_config["gcps"],
+        camera_config["lensPosition"],
+        camera_config["aoi"]["bbox"],
+        camera_config["resolution"],
+        camera_config["site"]["crs"],
+        movie["h_a"],
+    )
+
+
+def _velocity_hash(record, movie, piv_kwargs, stride, lag):
+    """
+    Hash of the inputs of computing velocities
+
+    :param record: dict, record of projected frames, None if not available
+    :param movie: dict, movie information
+    :param piv_kwargs: dict, arguments passed to piv algorithm
+    :param stride: int, only every stride-th frame pair is used
+    :param lag: int, frame n is paired with frame n + lag
+    :return: str, hash, None if record of projected frames is not available
+    """
+    return _stage_hash(
+        record,
+        piv_kwargs,
+        stride,
+        lag,
+        movie["camera_config"]["aoi_window_size"],
+        movie["camera_config"]["resolution"],
+        movie["timestamp"],
+        # velocities of frames passed to piv as int8 are outdated
+        "uint8",
+    )
+
+
+def _get_record(bucket, key):
+    """
+    Get record of a result in the bucket, stored as records/{key}.json
+
+    :param bucket: str, name of bucket
+    :param key: str, name (or prefix) of result in bucket
+    :return: dict, with hash of inputs and result of the step that made it, None if not available
+    """
+    s3 = utils.get_s3()
+    try:
+        return json.loads(s3.Object(bucket, f"records/{key}.json").get()["Body"].read())
+    except s3.meta.client.exceptions.NoSuchKey:
+        return None
+
+
+def _up_to_date(bucket, key, input_hash, logger=logging):
+    """
+    Check if a result in the bucket was made with the given inputs
+
+    :param bucket: str, name of bucket
+    :param key: str, name (or prefix) of result in bucket
+    :param input_hash: str, hash of inputs, None if the inputs are not known
+    :param logger: logger object
+    :return: dict, record of result (see _get_record) if it was made with the given inputs, otherwise None
+    """
+    if input_hash is None:
+        return None
+    record = _get_record(bucket, key)
+    if record is not None and record["hash"] == input_hash:
+        logger.info(f"{key} is up to date in {bucket}, skipping")
+        return record
+    return None
+
+
+def _set_record(bucket, key, input_hash, result=None):
+    """
+    Store record of a result in the bucket, stored as records/{key}.json
+
+    :param bucket: str, name of bucket
+    :param key: str, name (or prefix) of result in bucket
+    :param input_hash: str, hash of inputs with which result was made, if None, no record is stored
+    :param result: json serializable result of the step that made it
+    :return: None
+    """
+    s3 = utils.get_s3()
+    if input_hash is None:
+        # result cannot be traced back to its inputs, make sure an older record is not reused
+        s3.Object(bucket, f"records/{key}.json").delete()
+        return
+    s3.Object(bucket, f"records/{key}.json").put(
+        Body=json.dumps({"hash": input_hash, "result": result}).encode()
+    )
@@ -1,19 +1,368 @@
 import boto3
+import boto3.s3.transfer
 import os
+import collections
+import threading
+import contextlib
+import tempfile
+import concurrent.futures
+import cv2
+import OpenRiverCam
 import ibm_boto3
+import ibm_boto3.s3.transfer
 from ibm_botocore.client import Config
 
+# number of threads uploading to S3 per task, and maximum amount of queued uploads before producers are blocked
+UPLOAD_WORKERS = int(os.getenv("ORC_UPLOAD_WORKERS", 4))
+UPLOAD_QUEUE_SIZE = int(os.getenv("ORC_UPLOAD_QUEUE_SIZE", 16))
+# read movies directly from S3 with ranged requests instead of downloading them first
+STREAM_MOVIES = os.getenv("ORC_STREAM_MOVIES", "true") != "false"
+# seconds that urls of streamed movies are valid, these must stay valid until the last frame is decoded, which may
+# take as long as the whole task (maximum 7 days)
+MOVIE_URL_EXPIRES = int(os.getenv("ORC_MOVIE_URL_EXPIRES", 24 * 3600))
+# parent directory of per-task scratch directories, system default temporary directory if not set
+SCRATCH_DIR = os.getenv("ORC_SCRATCH_DIR")
+# maximum number of open connections kept per S3 connection
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("ORC_S3_MAX_POOL_CONNECTIONS", 16))
+# files larger than the threshold (MB) are transferred in parts of chunk size (MB), with max concurrency parallel parts
+S3_MULTIPART_THRESHOLD = int(os.getenv("ORC_S3_MULTIPART_THRESHOLD", 64))
+S3_MULTIPART_CHUNKSIZE = int(os.getenv("ORC_S3_MULTIPART_CHUNKSIZE", 16))
+S3_MAX_CONCURRENCY = int(os.getenv("ORC_S3_MAX_CONCURRENCY", 8))
+
+# S3 connection of this process, see get_s3: session and client shared by all threads, and a resource per thread
+_s3 = {}
+_s3_local = threading.local()
+_s3_lock = threading.Lock()
+
+
 def get_s3():
-    return boto3.resource(
-        "s3",
-        endpoint_url=os.getenv("S3_ENDPOINT_URL"),
-        aws_access_key_id=os.getenv("S3_ACCESS_KEY"),
-        aws_secret_access_key=os.getenv("S3_ACCESS_SECRET"),
-        config=boto3.session.Config(signature_version="s3v4"),
-    ) if os.getenv("FLASK_ENV") != "ibmcloud" else ibm_boto3.resource('s3',
+    """
+    Get boto3 resource connection to the S3 file storage. The session and client are made once per process and shared
+    by all its threads, so that the pool of open connections of the client is reused. Clients are thread safe, but
+    resources are not, therefore every thread gets its own resource, which sends its requests with the shared client.
+
+    :return: boto3 resource
+    """
+    resource = getattr(_s3_local, "resource", None)
+    if resource is None:
+        # sessions are not thread safe either, so clients and resources are made while holding the lock
+        with _s3_lock:
+            if "client" not in _s3:
+                _s3["session"], _s3["kwargs"] = _new_session()
+                _s3["client"] = _s3["session"].client("s3", **_s3["kwargs"])
+            resource = _s3["session"].resource("s3", **_s3["kwargs"])
+            # objects made from the resource (e.g. Bucket, Object) send their requests with the client of the resource
+            resource.meta.client = _s3["client"]
+        _s3_local.resource = resource
+    return resource
+
+
+def _reset_s3():
+    # a forked process must not share the connections of its parent, nor a lock that was held while forking
+    global _s3_local, _s3_lock
+    _s3.clear()
+    _s3_local = threading.local()
+    _s3_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_s3)
+
+
+def _new_session():
+    """
+    :return: tuple (session, kwargs), new boto3 session and the arguments of its S3 clients and resources
+    """
+    if os.getenv("FLASK_ENV") != "ibmcloud":
+        return boto3.session.Session(), dict(
+            endpoint_url=os.getenv("S3_ENDPOINT_URL"),
+            aws_access_key_id=os.getenv("S3_ACCESS_KEY"),
+            aws_secret_access_key=os.getenv("S3_ACCESS_SECRET"),
+            config=boto3.session.Config(signature_version="s3v4", max_pool_connections=S3_MAX_POOL_CONNECTIONS),
+        )
+    return ibm_boto3.session.Session(), dict(
         ibm_api_key_id=os.getenv('S3_ACCESS_KEY'),
         ibm_service_instance_id=os.getenv('S3_ACCESS_SECRET'),
         ibm_auth_endpoint=os.getenv('COS_AUTH_ENDPOINT'),
-        config=Config(signature_version="oauth"),
+        config=Config(signature_version="oauth", max_pool_connections=S3_MAX_POOL_CONNECTIONS),
         endpoint_url=os.getenv('S3_ENDPOINT_URL')
-    )
\ No newline at end of file
+    )
+
+
+def get_transfer_config():
+    """
+    Get configuration of file transfers, passed as Config to upload_file and download_file, so that large files are
+    transferred in parallel parts.
+
+    :return: TransferConfig
+    """
+    transfer = boto3.s3.transfer if os.getenv("FLASK_ENV") != "ibmcloud" else ibm_boto3.s3.transfer
+    return transfer.TransferConfig(
+        multipart_threshold=S3_MULTIPART_THRESHOLD * 1024 ** 2,
+        multipart_chunksize=S3_MULTIPART_CHUNKSIZE * 1024 ** 2,
+        max_concurrency=S3_MAX_CONCURRENCY,
+    )
+
+
+@contextlib.contextmanager
+def open_movie(bucket, key, stream=STREAM_MOVIES, expires=MOVIE_URL_EXPIRES):
+    """
+    Context manager providing a location from which a movie in the bucket can be read with OpenRiverCam.io.frames.
+    If streaming is possible, this is a presigned url, which the video reader reads with ranged requests while
+    decoding, so that decoding does not wait for the entire movie. Otherwise, the movie is downloaded to a local file,
+    which is removed afterwards.
+
+    :param bucket: str, name of bucket
+    :param key: str, name of movie in bucket
+    :param stream: bool, if True, a presigned url is provided where possible
+    :param expires: int, amount of seconds the presigned url is valid
+    :return: str, url or local file name of movie
+    """
+    s3 = get_s3()
+    # presigned urls are not supported with the oauth signature of IBM cloud storage
+    if stream and os.getenv("FLASK_ENV") != "ibmcloud":
+        yield s3.meta.client.generate_presigned_url(
+            "get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=expires
+        )
+    else:
+        with scratch_dir() as tmp:
+            fn = os.path.join(tmp, os.path.split(key)[1])
+            s3.Bucket(bucket).download_file(key, fn, Config=get_transfer_config())
+            yield fn
+
+
+def read_frames(fn, start_frame=None, end_frame=None, grayscale=False, lens_pars=None):
+    """
+    Generator of frames from a movie. If a window of frames is given, the reader seeks to start_frame, the decoder
+    starting from the nearest keyframe before it, and stops after end_frame, so that frames outside the window are
+    not decoded. Without window, all frames are read with OpenRiverCam.io.frames. The video reader ends a movie
+    silently if reading fails (e.g. an expired url), therefore an error is raised if reading stops before the last
+    frame and the movie turns out to contain more frames (see _check_frames).
+
+    :param fn: str, file name or url of movie
+    :param start_frame: int, first frame to read, None for the first frame of the movie
+    :param end_frame: int, last frame to read (inclusive), None for the last frame of the movie
+    :param grayscale: bool, if True, frames are converted to greyscale
+    :param lens_pars: dict, lens parameters (k1, c, f) used to undistort frames, if None, frames are not undistorted
+    :return: generator of tuples (t, img) with time in seconds and frame
+    """
+    if start_frame is None and end_frame is None:
+        cap = cv2.VideoCapture(fn)
+        n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+        n = 0
+        for frame in OpenRiverCam.io.frames(fn, grayscale=grayscale, lens_pars=lens_pars):
+            yield frame
+            n += 1
+        _check_frames(fn, n, n_frames - 1)
+        return
+    start_frame = start_frame or 0
+    if end_frame is not None and end_frame < start_frame:
+        raise ValueError(f"Start frame {start_frame} is larger than end frame {end_frame}")
+    cap = cv2.VideoCapture(fn)
+    try:
+        n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        n = 0
+        if start_frame > 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+            n = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+            if n != start_frame:
+                # container does not support seeking, skip frames without converting them
+                cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                n = 0
+                while n < start_frame and cap.grab():
+                    n += 1
+                if n < start_frame:
+                    raise ValueError(f"Start frame {start_frame} is larger than amount of frames {n}")
+        while end_frame is None or n <= end_frame:
+            ret, img = cap.read()
+            if not ret:
+                break
+            t = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+            if grayscale:
+                img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            if lens_pars is not None:
+                img = OpenRiverCam.cv.undistort_img(img, **lens_pars)
+            yield t, img
+            n += 1
+        _check_frames(fn, n, n_frames - 1 if end_frame is None else min(end_frame, n_frames - 1))
+    finally:
+        cap.release()
+
+
+def _check_frames(fn, n, last_frame):
+    """
+    Check that a movie was read until its last frame. The frame count of the container is an estimate (e.g. for
+    variable frame rate or edited movies), so if reading stopped before last_frame, the movie is opened again to check
+    whether frame n exists. If so, reading failed halfway, otherwise the movie simply has fewer frames than estimated.
+
+    :param fn: str, file name or url of movie
+    :param n: int, number of frames read from start of movie, including skipped frames
+    :param last_frame: int, last frame that should be read according to the frame count of the movie
+    :return: None
+    """
+    if n > last_frame:
+        return
+    cap = cv2.VideoCapture(fn)
+    try:
+        if not cap.isOpened():
+            raise ValueError(
+                f"Reading movie stopped after {n} frames, and the movie could not be opened again, its download may "
+                f"have failed"
+            )
+        cap.set(cv2.CAP_PROP_POS_FRAMES, n)
+        if int(cap.get(cv2.CAP_PROP_POS_FRAMES)) != n:
+            # container does not support seeking
+            cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            for _ in range(n):
+                if not cap.grab():
+                    return
+        if cap.grab():
+            raise ValueError(
+                f"Reading movie stopped after {n} of {last_frame + 1} frames, the movie may be damaged or its download "
+                f"failed"
+            )
+    finally:
+        cap.release()
+
+
+def get_zarr_store(bucket, key):
+    """
+    Get a key-value store for reading and writing a Zarr store in the bucket. Requires the optional dependencies
+    s3fs and zarr.
+
+    :param bucket: str, name of bucket
+    :param key: str, name of Zarr store in bucket
+    :return: s3fs.S3Map
+    """
+    if os.getenv("FLASK_ENV") == "ibmcloud":
+        raise ValueError("Zarr stores are not supported with the oauth signature of IBM cloud storage")
+    try:
+        import s3fs
+    except ImportError:
+        raise ImportError("Zarr stores in S3 require s3fs and zarr, install these with pip install s3fs zarr")
+    fs = s3fs.S3FileSystem(
+        key=os.getenv("S3_ACCESS_KEY"),
+        secret=os.getenv("S3_ACCESS_SECRET"),
+        client_kwargs={"endpoint_url": os.getenv("S3_ENDPOINT_URL")},
+    )
+    return s3fs.S3Map(root=f"{bucket}/{key}", s3=fs, check=False)
+
+
+def scratch_dir():
+    """
+    Create a scratch directory for temporary files of a task, so that tasks running at the same time do not overwrite
+    each other's files. Use as context manager, the directory and its content are removed at exit.
+
+    :return: tempfile.TemporaryDirectory, context manager providing the path of the scratch directory
+    """
+    return tempfile.TemporaryDirectory(prefix="orc_", dir=SCRATCH_DIR)
+
+
+def ordered_map(executor, fn, iterable, max_pending=4):
+    """
+    Apply fn to all items of iterable with an executor, yielding results in the order of iterable. At most max_pending
+    items are submitted and not yet yielded, so that memory stays bounded while the iterable is consumed.
+
+    :param executor: concurrent.futures.Executor
+    :param fn: callable, applied to each item
+    :param iterable: iterable of items
+    :param max_pending: int, maximum amount of submitted items that are not yet yielded
+    :return: generator of results
+    """
+    pending = collections.deque()
+    try:
+        for item in iterable:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+class Uploader(object):
+    """
+    Bounded queue of uploads to a bucket, drained by a pool of threads. Producers are blocked when queue_size uploads
+    are pending, so that memory stays bounded. Use as context manager, all uploads are flushed at exit.
+    """
+    def __init__(self, bucket, max_workers=UPLOAD_WORKERS, queue_size=UPLOAD_QUEUE_SIZE):
+        """
+        :param bucket: str, name of bucket
+        :param max_workers: int, number of upload threads
+        :param queue_size: int, maximum amount of pending uploads
+        """
+        self.bucket = bucket
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def _get_bucket(self):
+        # resource of the upload thread, objects are made per upload, so that threads do not share them
+        return get_s3().Bucket(self.bucket)
+
+    def _put(self, key, body):
+        self._get_bucket().Object(key).put(Body=body)
+
+    def _upload_file(self, fn, key, remove):
+        self._get_bucket().upload_file(fn, key, Config=get_transfer_config())
+        if remove:
+            os.remove(fn)
+
+    def _submit(self, fn, *args):
+        # raise errors of finished uploads early, instead of continuing to produce
+        for future in self._futures:
+            if future.done():
+                future.result()
+        self._futures = [future for future in self._futures if not future.done()]
+        # block until a slot in the queue is free
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        self._futures.append(future)
+
+    def put(self, key, body):
+        """
+        Queue upload of bytes to an object in the bucket
+
+        :param key: str, name of object in bucket
+        :param body: bytes, content of object
+        :return: None
+        """
+        self._submit(self._put, key, body)
+
+    def upload_file(self, fn, key, remove=False):
+        """
+        Queue upload of a local file to an object in the bucket
+
+        :param fn: str, local file name
+        :param key: str, name of object in bucket
+        :param remove: bool, if True, the local file is removed after upload
+        :return: None
+        """
+        self._submit(self._upload_file, fn, key, remove)
+
+    def flush(self):
+        """
+        Wait until all queued uploads are finished, raises the first error that occurred in any of the uploads
+
+        :return: None
+        """
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
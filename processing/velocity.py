@@ -0,0 +1,426 @@
+import os
+import logging
+import netCDF4
+import numpy as np
+import xarray as xr
+import utils
+
+# format in which velocities are stored in the bucket, "netcdf" (single file) or "zarr" (chunked store)
+FORMAT = os.getenv("ORC_VELOCITY_FORMAT", "netcdf")
+# amount of time steps per chunk in Zarr stores
+CHUNK_TIME = int(os.getenv("ORC_ZARR_CHUNK_TIME", 16))
+# memory budget in MB for one block of a velocity dataset that is processed at once, e.g. a band of rows with all
+# time steps, or a range of time steps of the whole grid
+BAND_MEMORY = int(os.getenv("ORC_BAND_MEMORY", 256))
+
+var_names = ["v_x", "v_y", "s2n", "corr"]
+var_attrs = [
+    {
+        "standard_name": "sea_water_x_velocity",
+        "long_name": "Flow element center velocity vector, x-component",
+        "units": "m s-1",
+        "coordinates": "lon lat",
+    },
+    {
+        "standard_name": "sea_water_y_velocity",
+        "long_name": "Flow element center velocity vector, y-component",
+        "units": "m s-1",
+        "coordinates": "lon lat",
+    },
+    {
+        "standard_name": "ratio",
+        "long_name": "signal to noise ratio",
+        "units": "",
+        "coordinates": "lon lat",
+    },
+    {
+        "standard_name": "correlation_coefficient",
+        "long_name": "correlation coefficient between frames",
+        "units": "",
+        "coordinates": "lon lat",
+    },
+]
+coord_attrs = {
+    "x": {"axis": "X", "long_name": "x-coordinate in Cartesian system", "units": "m"},
+    "y": {"axis": "Y", "long_name": "y-coordinate in Cartesian system", "units": "m"},
+    "xs": {"long_name": "x-coordinate in projected coordinate system", "units": "m"},
+    "ys": {"long_name": "y-coordinate in projected coordinate system", "units": "m"},
+    "lon": {"standard_name": "longitude", "long_name": "longitude", "units": "degrees_east"},
+    "lat": {"standard_name": "latitude", "long_name": "latitude", "units": "degrees_north"},
+}
+
+
+def filename(name, fmt=FORMAT):
+    """
+    Get name of velocity dataset in bucket
+
+    :param name: str, name of dataset without extension, e.g. "velocity" or "velocity_filter"
+    :param fmt: str, "netcdf" or "zarr"
+    :return: str, name of dataset in bucket
+    """
+    if fmt not in ["netcdf", "zarr"]:
+        raise ValueError(f'Velocity format must be "netcdf" or "zarr", found "{fmt}"')
+    return f"{name}.zarr" if fmt == "zarr" else f"{name}.nc"
+
+
+def open_velocity(bucket, name, tmp, fmt=FORMAT):
+    """
+    Get velocity dataset in bucket in a form accepted by xarray.open_dataset. A NetCDF file is downloaded to the
+    scratch directory, a Zarr store is read directly from the bucket, only fetching the chunks that are needed.
+
+    :param bucket: str, name of bucket
+    :param name: str, name of dataset without extension, e.g. "velocity" or "velocity_filter"
+    :param tmp: str, scratch directory
+    :param fmt: str, "netcdf" or "zarr"
+    :return: str (local file name) or xarray.backends.ZarrStore
+    """
+    key = filename(name, fmt)
+    if fmt == "zarr":
+        return xr.backends.ZarrStore.open_group(utils.get_zarr_store(bucket, key), mode="r")
+    fn = os.path.join(tmp, key)
+    utils.get_s3().Bucket(bucket).download_file(key, fn, Config=utils.get_transfer_config())
+    return fn
+
+
+def upload_velocity(fn, bucket, name, fmt=FORMAT):
+    """
+    Write local NetCDF file with velocities to bucket. For the Zarr format, the file is copied into a Zarr store
+    chunk by chunk, so that the dataset does not need to fit in memory.
+
+    :param fn: str, local NetCDF file with velocities
+    :param bucket: str, name of bucket
+    :param name: str, name of dataset without extension, e.g. "velocity" or "velocity_filter"
+    :param fmt: str, "netcdf" or "zarr"
+    :return: None
+    """
+    key = filename(name, fmt)
+    if fmt != "zarr":
+        utils.get_s3().Bucket(bucket).upload_file(fn, key, Config=utils.get_transfer_config())
+        return
+    store = utils.get_zarr_store(bucket, key)
+    with xr.open_dataset(fn) as ds:
+        for i in range(0, len(ds["time"]), CHUNK_TIME):
+            chunk = _drop_encoding(ds.isel(time=slice(i, i + CHUNK_TIME)).load())
+            if i == 0:
+                encoding = {
+                    var: {"chunks": (CHUNK_TIME, *chunk[var].shape[1:])}
+                    for var in chunk.data_vars
+                    if chunk[var].dims[0] == "time"
+                }
+                encoding["time"] = {"units": ds["time"].encoding["units"], "calendar": "standard"}
+                chunk.to_zarr(store, mode="w", encoding=encoding, consolidated=True)
+            else:
+                # variables without time dimension are written with the first chunk only
+                chunk = chunk.drop_vars([var for var in chunk.variables if "time" not in chunk[var].dims])
+                chunk.to_zarr(store, append_dim="time", consolidated=True)
+
+
+def _shape(src):
+    """
+    :param src: str or xarray.backends.ZarrStore, velocity dataset
+    :return: tuple (time, y, x), shape of velocity variables
+    """
+    with xr.open_dataset(src) as ds:
+        return ds[var_names[0]].shape
+
+
+def cell_blocks(src, memory=BAND_MEMORY, logger=logging):
+    """
+    Divide the grid of a velocity dataset in blocks of grid cells, of which all time steps fit within the memory
+    budget, e.g. for filters over time. Blocks are bands of whole rows, or parts of one row for long movies.
+
+    :param src: str or xarray.backends.ZarrStore, velocity dataset
+    :param memory: float, memory budget in MB for one block
+    :param logger: logger object
+    :return: list of tuples (rows, cols) with slices of rows and columns of each block
+    """
+    n_time, ny, nx = _shape(src)
+    # one float64 per variable, and room for a few intermediate copies while processing
+    cell_size = n_time * 8 * len(var_names) * 4
+    n_cells = int(memory * 2 ** 20 // cell_size)
+    if n_cells < 1:
+        logger.warning(
+            f"{n_time} time steps of one grid cell take {cell_size / 2 ** 20:.3g} MB, more than the memory budget of "
+            f"{memory} MB"
+        )
+        n_cells = 1
+    n_rows, n_cols = (n_cells // nx, nx) if n_cells >= nx else (1, n_cells)
+    return [
+        (slice(row, min(row + n_rows, ny)), slice(col, min(col + n_cols, nx)))
+        for row in range(0, ny, n_rows)
+        for col in range(0, nx, n_cols)
+    ]
+
+
+def time_blocks(src, memory=BAND_MEMORY, logger=logging):
+    """
+    Divide the time steps of a velocity dataset in blocks, of which the whole grid fits within the memory budget,
+    e.g. for filters over space
+
+    :param src: str or xarray.backends.ZarrStore, velocity dataset
+    :param memory: float, memory budget in MB for one block
+    :param logger: logger object
+    :return: list of slices of time steps of each block
+    """
+    n_time, ny, nx = _shape(src)
+    step_size = ny * nx * 8 * len(var_names) * 4
+    n_steps = int(memory * 2 ** 20 // step_size)
+    if n_steps < 1:
+        logger.warning(
+            f"One time step of {ny} x {nx} grid cells takes {step_size / 2 ** 20:.3g} MB, more than the memory budget "
+            f"of {memory} MB"
+        )
+        n_steps = 1
+    return [slice(start, min(start + n_steps, n_time)) for start in range(0, n_time, n_steps)]
+
+
+def read_block(src, times=slice(None), rows=slice(None), cols=slice(None)):
+    """
+    Read a block of a velocity dataset into memory
+
+    :param src: str or xarray.backends.ZarrStore, velocity dataset
+    :param times: slice, time steps of block
+    :param rows: slice, rows of block
+    :param cols: slice, columns of block
+    :return: xarray.Dataset
+    """
+    with xr.open_dataset(src) as ds:
+        return _drop_encoding(ds.isel(time=times, y=rows, x=cols).load())
+
+
+def _drop_encoding(ds):
+    """
+    Remove encoding of source file (e.g. chunk sizes, compression) from variables of dataset, so that a part of the
+    dataset can be written to another file.
+
+    :param ds: xarray.Dataset
+    :return: xarray.Dataset
+    """
+    ds.encoding = {}
+    for var in ds.variables.values():
+        var.encoding = {}
+    return ds
+
+
+def grid_axes(cols, rows, resolution):
+    """
+    Get local x and y axes of the PIV grid
+
+    :param cols: np.ndarray, columns of PIV grid in projected frame
+    :param rows: np.ndarray, rows of PIV grid in projected frame
+    :param resolution: float, resolution of projected frames
+    :return: x, y (np.ndarray)
+    """
+    spacing_x = np.diff(cols[0])[0]
+    spacing_y = np.diff(rows[:, 0])[0]
+    x = np.linspace(
+        resolution / 2 * spacing_x,
+        (len(cols[0]) - 0.5) * resolution * spacing_x,
+        len(cols[0]),
+    )
+    y = np.flipud(
+        np.linspace(
+            resolution / 2 * spacing_y,
+            (len(rows[:, 0]) - 0.5) * resolution * spacing_y,
+            len(rows[:, 0]),
+        )
+    )
+    return x, y
+
+
+class VelocityWriter(object):
+    """
+    Writes velocities of frame pairs to a NetCDF file one time step at a time, along an unlimited time dimension, so
+    that only one time step needs to be in memory.
+    """
+    def __init__(self, fn, start_time, x, y, xs, ys, lons, lats):
+        """
+        :param fn: str, local file name of NetCDF file
+        :param start_time: datetime, reference time of time axis
+        :param x: np.ndarray (1D), local x-axis of grid
+        :param y: np.ndarray (1D), local y-axis of grid
+        :param xs: np.ndarray (2D), x-coordinates of grid in projected coordinate system
+        :param ys: np.ndarray (2D), y-coordinates of grid in projected coordinate system
+        :param lons: np.ndarray (2D), longitudes of grid
+        :param lats: np.ndarray (2D), latitudes of grid
+        """
+        self.ds = netCDF4.Dataset(fn, "w")
+        self.ds.createDimension("time", None)
+        self.ds.createDimension("y", len(y))
+        self.ds.createDimension("x", len(x))
+        self.time = self.ds.createVariable("time", "f8", ("time",))
+        self.time.units = "seconds since {}".format(start_time.strftime("%Y-%m-%d %H:%M:%S"))
+        self.time.calendar = "standard"
+        for name, values in zip(["x", "y"], [x, y]):
+            var = self.ds.createVariable(name, "f8", (name,))
+            var.setncatts(coord_attrs[name])
+            var[:] = values
+        for name, values in zip(["xs", "ys", "lon", "lat"], [xs, ys, lons, lats]):
+            var = self.ds.createVariable(name, "f8", ("y", "x"), zlib=True)
+            var.setncatts(coord_attrs[name])
+            var[:] = values
+        self.vars = []
+        for name, attrs in zip(var_names, var_attrs):
+            # one chunk per time step, so that appending does not touch earlier time steps
+            var = self.ds.createVariable(
+                name, "f8", ("time", "y", "x"), zlib=True, chunksizes=(1, len(y), len(x)), fill_value=np.nan
+            )
+            var.setncatts(attrs)
+            self.vars.append(var)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def append(self, time, arrays):
+        """
+        Append one time step
+
+        :param time: datetime, time of time step
+        :param arrays: list of np.ndarrays (2D), with v_x, v_y, s2n and corr
+        :return: None
+        """
+        i = len(self.time)
+        self.time[i] = netCDF4.date2num(time, self.time.units, calendar=self.time.calendar)
+        for var, values in zip(self.vars, arrays):
+            var[i] = values
+
+    def close(self):
+        self.ds.close()
+
+
+class BlockWriter(object):
+    """
+    Writes a velocity dataset to a NetCDF file one block at a time (e.g. a band of rows with all time steps, or a range
+    of time steps of the whole grid), so that only one block needs to be in memory. Times and variables without time
+    dimension are copied from the source dataset.
+    """
+    def __init__(self, fn, src, chunksizes):
+        """
+        :param fn: str, local file name of NetCDF file
+        :param src: str or xarray.backends.ZarrStore, source velocity dataset, of which time and grid are copied
+        :param chunksizes: tuple (time, y, x), chunk sizes of variables, preferably the size of the blocks that are
+            written or read later on, None for the whole dimension
+        """
+        # times are read as stored, so that they are copied with their own units and calendar
+        with xr.open_dataset(src, decode_times=False) as ds:
+            static = [var for var in ds.data_vars if "time" not in ds[var].dims]
+            _drop_encoding(ds[static].load()).to_netcdf(fn)
+            times = ds["time"].values
+            time_attrs = {"units": ds["time"].attrs["units"], "calendar": ds["time"].attrs.get("calendar", "standard")}
+        self.ds = netCDF4.Dataset(fn, "a")
+        self.ds.createDimension("time", None)
+        time = self.ds.createVariable("time", "f8", ("time",))
+        time.setncatts(time_attrs)
+        time[:] = times
+        shape = (len(times), len(self.ds.dimensions["y"]), len(self.ds.dimensions["x"]))
+        self.chunksizes = tuple(max(min(size or n, n), 1) for size, n in zip(chunksizes, shape))
+        self.vars = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def write(self, block, times=slice(None), rows=slice(None), cols=slice(None)):
+        """
+        Write one block
+
+        :param block: xarray.Dataset, with dimensions time, y, x
+        :param times: slice, time steps of block in dataset
+        :param rows: slice, rows of block in dataset
+        :param cols: slice, columns of block in dataset
+        :return: None
+        """
+        for name, da in block.data_vars.items():
+            if "time" not in da.dims:
+                continue
+            if name not in self.vars:
+                var = self.ds.createVariable(
+                    name, "f8", ("time", "y", "x"), zlib=True, chunksizes=self.chunksizes, fill_value=np.nan
+                )
+                var.setncatts({k: v for k, v in da.attrs.items() if k != "_FillValue"})
+                self.vars[name] = var
+            self.vars[name][times, rows, cols] = da.transpose("time", "y", "x").values
+
+    def close(self):
+        self.ds.close()
+
+
+class ZarrVelocityWriter(object):
+    """
+    Writes velocities of frame pairs to a Zarr store, appending chunks of chunk_time time steps along the time
+    dimension, so that only one chunk needs to be in memory and earlier chunks are not rewritten.
+    """
+    def __init__(self, store, start_time, x, y, xs, ys, lons, lats, chunk_time=CHUNK_TIME):
+        """
+        :param store: mutable mapping, e.g. s3fs.S3Map, in which Zarr store is written
+        :param start_time: datetime, reference time of time axis
+        :param x: np.ndarray (1D), local x-axis of grid
+        :param y: np.ndarray (1D), local y-axis of grid
+        :param xs: np.ndarray (2D), x-coordinates of grid in projected coordinate system
+        :param ys: np.ndarray (2D), y-coordinates of grid in projected coordinate system
+        :param lons: np.ndarray (2D), longitudes of grid
+        :param lats: np.ndarray (2D), latitudes of grid
+        :param chunk_time: int, amount of time steps per chunk
+        """
+        self.store = store
+        self.units = "seconds since {}".format(start_time.strftime("%Y-%m-%d %H:%M:%S"))
+        self.chunk_time = chunk_time
+        self.coords = {"x": ("x", x, coord_attrs["x"]), "y": ("y", y, coord_attrs["y"])}
+        for name, values in zip(["xs", "ys", "lon", "lat"], [xs, ys, lons, lats]):
+            self.coords[name] = (("y", "x"), values, coord_attrs[name])
+        self.time = []
+        self.arrays = []
+        self.written = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def append(self, time, arrays):
+        """
+        Append one time step, written to the store once a chunk is complete
+
+        :param time: datetime, time of time step
+        :param arrays: list of np.ndarrays (2D), with v_x, v_y, s2n and corr
+        :return: None
+        """
+        self.time.append(time)
+        self.arrays.append(arrays)
+        if len(self.time) == self.chunk_time:
+            self.flush()
+
+    def flush(self):
+        """
+        Write buffered time steps to the store
+
+        :return: None
+        """
+        if not self.time:
+            return
+        ds = xr.Dataset(
+            {
+                name: (("time", "y", "x"), np.stack([arrays[i] for arrays in self.arrays]), attrs)
+                for i, (name, attrs) in enumerate(zip(var_names, var_attrs))
+            },
+            coords={"time": self.time},
+        )
+        if self.written:
+            ds.to_zarr(self.store, append_dim="time", consolidated=True)
+        else:
+            ds = ds.assign_coords(self.coords)
+            encoding = {name: {"chunks": (self.chunk_time, *ds[name].shape[1:])} for name in var_names}
+            encoding["time"] = {"units": self.units, "calendar": "standard"}
+            ds.to_zarr(self.store, mode="w", encoding=encoding, consolidated=True)
+            self.written = True
+        self.time = []
+        self.arrays = []
+
+    def close(self):
+        self.flush()
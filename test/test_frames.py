@@ -11,7 +11,7 @@ connection = pika.BlockingConnection(
 )
 channel = connection.channel()
 
-channel.queue_declare(queue="processing")
-channel.basic_publish(exchange="", routing_key="processing", body=json.dumps(body))
+channel.queue_declare(queue="processing_interactive")
+channel.basic_publish(exchange="", routing_key="processing_interactive", body=json.dumps(body))
 print(" [x] Sent 'frames'")
 connection.close()
@@ -0,0 +1,42 @@
+import os
+import sys
+import cv2
+import numpy as np
+from shapely.geometry import shape
+from example_data import bbox, movie
+
+# runs locally, without queue, with the dependencies of the processing node
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "processing"))
+import OpenRiverCam
+import tasks
+
+camera_config = dict(movie["camera_config"], aoi={"bbox": bbox})
+cols, rows = [int(n) for n in movie["resolution"].split("x")]
+# smooth sample frame without zeros, so that pixels inside and outside the frame can be told apart
+ys, xs = np.mgrid[0:rows, 0:cols]
+img = np.uint8(127.5 + 63 * np.sin(xs / 37) + 63 * np.cos(ys / 23))
+
+# projection of one frame as done per frame before remap tables were introduced
+expected, expected_transform = OpenRiverCam.cv.orthorectification(
+    img=img,
+    lensPosition=camera_config["lensPosition"],
+    h_a=movie["h_a"],
+    bbox=shape(bbox["features"][0]["geometry"]),
+    resolution=camera_config["resolution"],
+    **camera_config["gcps"],
+)
+map1, map2, transform = tasks._get_remap(camera_config, movie["h_a"], img.shape)
+result = cv2.remap(img, map1, map2, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+
+assert result.shape == expected.shape, f"Expected shape {expected.shape}, found {result.shape}"
+assert np.allclose(tuple(transform), tuple(expected_transform)), f"Expected {expected_transform}, found {transform}"
+# both interpolate with 1/32 pixel precision, pixels along the edge of the frame are interpolated with the border
+inside = (result > 0) & (expected > 0)
+assert inside.any(), "Projected frame does not overlap with the movie frame"
+diff = np.abs(np.float64(result) - np.float64(expected))[inside]
+assert diff.mean() < 1, f"Mean difference {diff.mean():.2f} exceeds tolerance of 1"
+assert diff.max() <= 8, f"Maximum difference {diff.max():.0f} exceeds tolerance of 8"
+# pixels outside the frame are zero in both
+outside = np.mean((result == 0) != (expected == 0))
+assert outside < 0.01, f"{outside:.1%} of pixels differ in whether they lie outside the frame"
+print(f" [x] Remap table matches orthorectification, mean difference {diff.mean():.2f}, maximum {diff.max():.0f}")
@@ -0,0 +1,47 @@
+import os
+import sys
+import tempfile
+import datetime
+import numpy as np
+import xarray as xr
+
+# runs locally, without queue, with the dependencies of the processing node
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "processing"))
+import velocity
+
+n_time, ny, nx = 5, 23, 7
+start_time = datetime.datetime(2021, 1, 1, 12, 0, 0)
+x = np.arange(nx) * 0.5 + 0.25
+y = np.flipud(np.arange(ny) * 0.5 + 0.25)
+xs, ys = np.meshgrid(x + 1000, y + 2000)
+lons, lats = xs / 1e5, ys / 1e5
+data = np.random.rand(n_time, len(velocity.var_names), ny, nx)
+
+with tempfile.TemporaryDirectory() as tmp:
+    src = os.path.join(tmp, "velocity.nc")
+    with velocity.VelocityWriter(src, start_time, x, y, xs, ys, lons, lats) as writer:
+        for n in range(n_time):
+            writer.append(start_time + datetime.timedelta(seconds=0.04 * n), list(data[n]))
+
+    # small memory budget, so that the dataset is divided in several blocks of grid cells and of time steps, as in
+    # filter_piv
+    cell_blocks = velocity.cell_blocks(src, memory=0.02)
+    time_blocks = velocity.time_blocks(src, memory=0.05)
+    assert len(cell_blocks) > 1, f"Expected several blocks of grid cells, found {len(cell_blocks)}"
+    assert len(time_blocks) > 1, f"Expected several blocks of time steps, found {len(time_blocks)}"
+    temporal_fn = os.path.join(tmp, "velocity_temporal.nc")
+    rows, cols = cell_blocks[0]
+    chunksizes = (time_blocks[0].stop - time_blocks[0].start, rows.stop - rows.start, cols.stop - cols.start)
+    with velocity.BlockWriter(temporal_fn, src, chunksizes) as writer:
+        for rows, cols in cell_blocks:
+            writer.write(velocity.read_block(src, rows=rows, cols=cols), rows=rows, cols=cols)
+    fn = os.path.join(tmp, "velocity_filter.nc")
+    with velocity.BlockWriter(fn, src, (1, None, None)) as writer:
+        for times in time_blocks:
+            writer.write(velocity.read_block(temporal_fn, times=times), times=times)
+
+    with xr.open_dataset(src) as expected, xr.open_dataset(fn) as result:
+        xr.testing.assert_identical(expected["time"], result["time"])
+        for var in velocity.var_names + ["xs", "ys"]:
+            xr.testing.assert_allclose(expected[var], result[var])
+print(f" [x] Round trip of {len(cell_blocks)} blocks of grid cells and {len(time_blocks)} blocks of time steps successful")